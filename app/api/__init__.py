@@ -3,6 +3,9 @@ from fastapi.routing import APIRouter
 from .auth import router as auth_router
 from .conversations import router as conv_router
 from .groups import router as group_router
+from .health import router as health_router
+from .inbox import router as inbox_router
+from .sync import router as sync_router
 from .users import router as user_router
 
 api_router = APIRouter(prefix='/api')
@@ -10,6 +13,9 @@ api_router = APIRouter(prefix='/api')
 api_router.include_router(auth_router)
 api_router.include_router(conv_router)
 api_router.include_router(group_router)
+api_router.include_router(health_router)
+api_router.include_router(inbox_router)
+api_router.include_router(sync_router)
 api_router.include_router(user_router)
 
 __all__ = ['api_router']
@@ -1,12 +1,19 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.routing import APIRouter
 from pydantic import BaseModel, Field
-from sqlmodel import Session, select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from config import PASSWORD_REGEX
-from db.session import get_session
+from db.session import get_async_session
 from schemas import User
-from utils.auth import get_password_hash, create_access_token, verify_password
+from utils.auth import (
+    PasswordHasherBusy,
+    create_access_token,
+    get_password_hash_async,
+    verify_password_async,
+)
 
 router = APIRouter(prefix='/auth')
 
@@ -20,6 +27,14 @@ class SuccessfulAuthResponse(BaseModel):
     token_type: str = 'bearer'
 
 
+def server_busy() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail='Too many authentication requests, try again shortly',
+        headers={'Retry-After': '1'},
+    )
+
+
 class FailedAuthResponse(BaseModel):
     status_code: int = status.HTTP_401_UNAUTHORIZED
     detail: str = 'Incorrect username or password'
@@ -27,18 +42,27 @@ class FailedAuthResponse(BaseModel):
 
 
 @router.post('/register')
-async def register(data: LoginRequest, session: Session = Depends(get_session)) -> SuccessfulAuthResponse:
-    existing = session.exec(select(User).where(User.username == data.username)).first()
+async def register(data: LoginRequest, session: AsyncSession = Depends(get_async_session)) -> SuccessfulAuthResponse:
+    existing = (await session.exec(select(User).where(User.username == data.username))).first()
     if existing:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Username already registered')
 
+    try:
+        password_hash = await get_password_hash_async(data.password)
+    except PasswordHasherBusy:
+        raise server_busy()
+
     user = User(
         username=data.username,
-        password_hash=get_password_hash(data.password),
+        password_hash=password_hash,
     )
     session.add(user)
-    session.commit()
-    session.refresh(user)
+    try:
+        await session.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent register for the same name.
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Username already registered')
+    await session.refresh(user)
 
     token = create_access_token({'sub': str(user.id), 'username': user.username})
     return SuccessfulAuthResponse(token=token)
@@ -50,11 +74,19 @@ async def register(data: LoginRequest, session: Session = Depends(get_session))
             'model': FailedAuthResponse,
             'description': 'Incorrect Username or Password',
         },
+        status.HTTP_503_SERVICE_UNAVAILABLE: {
+            'description': 'Password hashing pool saturated',
+        },
     },
 )
-async def login(data: LoginRequest, session: Session = Depends(get_session)) -> SuccessfulAuthResponse:
-    user = session.exec(select(User).where(User.username == data.username)).first()
-    if not user or not verify_password(data.password, user.password_hash):
+async def login(data: LoginRequest, session: AsyncSession = Depends(get_async_session)) -> SuccessfulAuthResponse:
+    user = (await session.exec(select(User).where(User.username == data.username))).first()
+    try:
+        verified = user is not None and await verify_password_async(data.password, user.password_hash)
+    except PasswordHasherBusy:
+        raise server_busy()
+
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail='Incorrect username or password',
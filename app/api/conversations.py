@@ -1,16 +1,22 @@
 import uuid
+from datetime import datetime, UTC
 from typing import Annotated
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, Request, status
 from fastapi.routing import APIRouter
 from pydantic import BaseModel
 
-from db.session import get_session
+from db.session import get_async_session, get_read_session
 from schemas import Conversation, ConversationParticipant, Message, User
 from schemas.conversation_participant import ParticipantRole
-from services.messaging import MessageInformation, get_messages
-from sqlmodel import Session, select
+from services.inbox import add_inbox_entries, record_message
+from services.sync import MESSAGE_CREATED, record_event
+from services.membership_cache import notify_membership_changed
+from services.messaging import BadRequestError, MessagePage, get_messages
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from utils.auth import get_token_user_id_http
+from ws.connection import manager
 
 router = APIRouter(prefix='/conversations')
 
@@ -38,11 +44,12 @@ class ConversationInformation(BaseModel):
 @router.post('/create')
 async def create_conversation(
     data: CreateConversationRequest,
+    request: Request,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> Conversation:
-    user = session.get(User, user_id)
-    other = session.get(User, data.other_id)
+    user = await session.get(User, user_id)
+    other = await session.get(User, data.other_id)
 
     if not other:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, detail='Adding a non-existing user')
@@ -65,8 +72,17 @@ async def create_conversation(
     session.add(conversation)
     session.add(creating_participant)
     session.add(other_participant)
-    session.commit()
-    session.refresh(conversation)
+    await session.flush()
+    await add_inbox_entries(session, conversation.id, (user.id, other.id), datetime.now(tz=UTC))
+    await session.commit()
+    await session.refresh(conversation)
+
+    await notify_membership_changed(
+        request.app.state.message_publisher,
+        conversation.id,
+        added=(user.id, other.id),
+        presence=manager.presence,
+    )
 
     return conversation
 
@@ -74,13 +90,13 @@ async def create_conversation(
 @router.get('')
 async def get_conversations(
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
 ) -> list[Conversation]:
-    conversations = session.exec(
+    conversations = (await session.exec(
         select(ConversationParticipant.conversation_id.label('id'), Conversation.title)
         .where(ConversationParticipant.user_id == user_id, Conversation.is_group == False, Conversation.deleted == False)
         .join(Conversation, Conversation.id == ConversationParticipant.conversation_id)
-    ).all()
+    )).all()
 
     return list(conversations)
 
@@ -89,14 +105,20 @@ async def get_conversations(
 async def get_conversation_messages(
     conversation_id: uuid.UUID,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
-) -> list[MessageInformation]:
-    conversation = session.get(Conversation, conversation_id)
-    conversation_participant = session.get(ConversationParticipant, (conversation_id, user_id))
+    before: Annotated[str | None, Query()] = None,
+    after: Annotated[str | None, Query()] = None,
+    limit: Annotated[int, Query(ge=1, le=200)] = 50,
+    session: AsyncSession = Depends(get_read_session),
+) -> MessagePage:
+    conversation = await session.get(Conversation, conversation_id)
+    conversation_participant = await session.get(ConversationParticipant, (conversation_id, user_id))
     if not conversation or conversation.deleted or not conversation_participant:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail='Conversation not found')
 
-    return get_messages(session, conversation_id)
+    try:
+        return await get_messages(session, conversation_id, before=before, after=after, limit=limit)
+    except BadRequestError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
 @router.post('/{conversation_id}/messages')
@@ -104,13 +126,13 @@ async def send_message(
     conversation_id: uuid.UUID,
     data: MessageCreate,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> Message:
-    conversation = session.get(Conversation, conversation_id)
+    conversation = await session.get(Conversation, conversation_id)
     if not conversation or conversation.deleted:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail='Conversation not found')
 
-    participant = session.get(ConversationParticipant, (conversation_id, user_id))
+    participant = await session.get(ConversationParticipant, (conversation_id, user_id))
     if not participant:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail='You are not part of this conversation')
 
@@ -121,8 +143,11 @@ async def send_message(
     )
 
     session.add(new_message)
-    session.commit()
-    session.refresh(new_message)
+    await session.flush()
+    await record_message(session, conversation_id, new_message.id, user_id, new_message.created_at)
+    await record_event(session, MESSAGE_CREATED, conversation_id, new_message.created_at, new_message.id, user_id)
+    await session.commit()
+    await session.refresh(new_message)
 
     return new_message
 
@@ -130,11 +155,12 @@ async def send_message(
 @router.delete('/{conversation_id}', status_code=status.HTTP_204_NO_CONTENT)
 async def delete_conversation(
     conversation_id: uuid.UUID,
+    request: Request,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> None:
-    conversation = session.get(Conversation, conversation_id)
-    conversation_participant = session.get(ConversationParticipant, (conversation_id, user_id))
+    conversation = await session.get(Conversation, conversation_id)
+    conversation_participant = await session.get(ConversationParticipant, (conversation_id, user_id))
     if not conversation or conversation.deleted or not conversation_participant:
         return
     
@@ -143,6 +169,7 @@ async def delete_conversation(
     
     conversation.deleted = True
     session.add(conversation)
-    session.commit()
+    await session.commit()
 
+    await notify_membership_changed(request.app.state.message_publisher, conversation_id, deleted=True, presence=manager.presence)
     return
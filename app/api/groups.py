@@ -1,16 +1,21 @@
 import uuid
+from datetime import datetime, UTC
 from typing import Annotated
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Query, Request, status
 from fastapi.routing import APIRouter
 from pydantic import BaseModel, Field
 
-from db.session import get_session
+from db.session import get_async_session, get_read_session
 from schemas import Conversation, ConversationParticipant, User
 from schemas.conversation_participant import ParticipantRole
-from services.messaging import MessageInformation, get_messages
-from sqlmodel import Session, select
+from services.inbox import add_inbox_entries, remove_inbox_entry
+from services.membership_cache import notify_membership_changed
+from services.messaging import BadRequestError, MessagePage, get_messages
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from utils.auth import get_token_user_id_http
+from ws.connection import manager
 
 router = APIRouter(prefix='/groups')
 
@@ -24,6 +29,7 @@ class ParticipantInformation(BaseModel):
     username: str
     display_name: str | None
     role: ParticipantRole
+    last_read_message_id: uuid.UUID | None = None
 
 
 class GroupInformation(BaseModel):
@@ -36,28 +42,29 @@ class GroupInformation(BaseModel):
 @router.get('')
 async def get_groups(
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
 ) -> list[GroupInformation]:
-    groups = session.exec(
+    groups = (await session.exec(
         select(ConversationParticipant.conversation_id.label('id'), Conversation.title, ConversationParticipant.role)
         .where(ConversationParticipant.user_id == user_id, Conversation.is_group == True, Conversation.deleted == False)
         .join(Conversation, Conversation.id == ConversationParticipant.conversation_id)
-    ).all()
+    )).all()
 
     return list(groups)
 
 @router.post('/create')
 async def create_group(
     data: CreateGroupRequest,
+    request: Request,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> Conversation:
     ids = set(data.participant_ids.copy())
 
     if user_id in ids:
         ids.remove(user_id)
 
-    added_participants = session.exec(select(User.id).where(User.id.in_(ids))).all()
+    added_participants = (await session.exec(select(User.id).where(User.id.in_(ids)))).all()
     if len(added_participants) != len(ids):
         raise HTTPException(status.HTTP_400_BAD_REQUEST, detail='Adding non-existing user(s)')
 
@@ -80,19 +87,29 @@ async def create_group(
 
     session.add(group)
     session.add_all(participants)
-    session.commit()
-    session.refresh(group)
+    await session.flush()
+    await add_inbox_entries(session, group.id, [p.user_id for p in participants], datetime.now(tz=UTC))
+    await session.commit()
+    await session.refresh(group)
+
+    await notify_membership_changed(
+        request.app.state.message_publisher,
+        group.id,
+        added=[p.user_id for p in participants],
+        presence=manager.presence,
+    )
 
     return group
 
 @router.delete('/{group_id}', status_code=status.HTTP_204_NO_CONTENT)
 async def delete_group(
     group_id: uuid.UUID,
+    request: Request,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> None:
-    conversation = session.get(Conversation, group_id)
-    conversation_participant = session.get(ConversationParticipant, (group_id, user_id))
+    conversation = await session.get(Conversation, group_id)
+    conversation_participant = await session.get(ConversationParticipant, (group_id, user_id))
     if not conversation or conversation.deleted or not conversation_participant:
         return
     
@@ -104,18 +121,22 @@ async def delete_group(
     
     conversation.deleted = True
     session.add(conversation)
-    session.commit()
+    await session.commit()
 
+    await notify_membership_changed(request.app.state.message_publisher, group_id, deleted=True, presence=manager.presence)
     return
 
 @router.get('/{group_id}/messages')
 async def get_group_messages(
     group_id: uuid.UUID,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
-) -> list[MessageInformation]:
-    group = session.get(Conversation, group_id)
-    group_participant = session.get(ConversationParticipant, (group_id, user_id))
+    before: Annotated[str | None, Query()] = None,
+    after: Annotated[str | None, Query()] = None,
+    limit: Annotated[int, Query(ge=1, le=200)] = 50,
+    session: AsyncSession = Depends(get_read_session),
+) -> MessagePage:
+    group = await session.get(Conversation, group_id)
+    group_participant = await session.get(ConversationParticipant, (group_id, user_id))
 
     if not group or group.deleted:
         raise HTTPException(status.HTTP_404_NOT_FOUND, detail='Conversation not found')
@@ -123,25 +144,34 @@ async def get_group_messages(
     if not group_participant:
         raise HTTPException(status.HTTP_403_FORBIDDEN, detail='You have no access to the group')
 
-    return get_messages(session, group_id)
+    try:
+        return await get_messages(session, group_id, before=before, after=after, limit=limit)
+    except BadRequestError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
 
 
 @router.get('/{group_id}/participants')
 async def get_group_participants(
     group_id: uuid.UUID,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
 ) -> list[ParticipantInformation]:
-    group = session.get(Conversation, group_id)
-    requesting_participant = session.get(ConversationParticipant, (group_id, user_id))
+    group = await session.get(Conversation, group_id)
+    requesting_participant = await session.get(ConversationParticipant, (group_id, user_id))
     if not group or group.deleted or not requesting_participant:
         raise HTTPException(status.HTTP_404_NOT_FOUND, 'Could not find group')
 
-    participants = session.exec(
-        select(User.id, User.username, User.display_name, ConversationParticipant.role)
+    participants = (await session.exec(
+        select(
+            User.id,
+            User.username,
+            User.display_name,
+            ConversationParticipant.role,
+            ConversationParticipant.last_read_message_id,
+        )
         .join(ConversationParticipant)
         .where(ConversationParticipant.conversation_id == group_id)
-    ).all()
+    )).all()
 
     return participants
 
@@ -150,12 +180,13 @@ async def get_group_participants(
 async def add_group_participant(
     group_id: uuid.UUID,
     participant_id: uuid.UUID,
+    request: Request,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> None:
-    group = session.get(Conversation, group_id)
-    adder = session.get(ConversationParticipant, (group_id, user_id))
-    to_add = session.get(User, participant_id)
+    group = await session.get(Conversation, group_id)
+    adder = await session.get(ConversationParticipant, (group_id, user_id))
+    to_add = await session.get(User, participant_id)
     if not group or group.deleted or not adder:
         raise HTTPException(status.HTTP_404_NOT_FOUND, 'Could not find group')
     
@@ -170,8 +201,11 @@ async def add_group_participant(
         user_id=participant_id
     )
     session.add(added_participant)
-    session.commit()
+    await session.flush()
+    await add_inbox_entries(session, group_id, (participant_id,), datetime.now(tz=UTC))
+    await session.commit()
 
+    await notify_membership_changed(request.app.state.message_publisher, group_id, added=(participant_id,), presence=manager.presence)
     return None
 
 
@@ -179,12 +213,13 @@ async def add_group_participant(
 async def remove_group_participant(
     group_id: uuid.UUID,
     participant_id: uuid.UUID,
+    request: Request,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ) -> None:
-    group = session.get(Conversation, group_id)
-    remover = session.get(ConversationParticipant, (group_id, user_id))
-    to_remove = session.get(ConversationParticipant, (group_id, participant_id))
+    group = await session.get(Conversation, group_id)
+    remover = await session.get(ConversationParticipant, (group_id, user_id))
+    to_remove = await session.get(ConversationParticipant, (group_id, participant_id))
     if not group or group.deleted or not to_remove or not remover:
         return
     
@@ -194,7 +229,10 @@ async def remove_group_participant(
     if participant_id != user_id and remover.role != ParticipantRole.ADMIN:
         raise HTTPException(status.HTTP_403_FORBIDDEN, 'Only admin can remove other members from a group')
     
-    session.delete(to_remove)
-    session.commit()
+    await session.delete(to_remove)
+    await remove_inbox_entry(session, group_id, participant_id)
+    await session.commit()
+
+    await notify_membership_changed(request.app.state.message_publisher, group_id, removed=(participant_id,), presence=manager.presence)
     return
 
@@ -0,0 +1,25 @@
+from fastapi import Request
+from fastapi.routing import APIRouter
+
+from db.session import pool_stats
+from services.group_commit import group_commit_writer
+from services.outbox import outbox_relay
+from services.rmq_ws_bridge import bridge_dedup_stats
+from utils.auth import password_hash_pool_stats, token_cache_stats
+from ws.connection import manager
+
+router = APIRouter(prefix='/health')
+
+@router.get('')
+async def health(request: Request):
+    return {
+        'status': 'ok',
+        'db_pool': pool_stats(),
+        'group_commit': group_commit_writer.stats(),
+        'outbox': outbox_relay.stats(),
+        'bridge_dedup': bridge_dedup_stats(),
+        'password_hash_pool': password_hash_pool_stats(),
+        'token_cache': token_cache_stats(),
+        'idle_timer': manager.idle_timer.stats(),
+        'consumers': [consumer.stats() for consumer in getattr(request.app.state, 'consumers', [])],
+    }
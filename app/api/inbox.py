@@ -0,0 +1,25 @@
+import uuid
+from typing import Annotated
+
+from fastapi import Depends, HTTPException, Query, status
+from fastapi.routing import APIRouter
+
+from db.session import get_read_session
+from services.inbox import InboxPage, get_inbox
+from services.messaging import BadRequestError
+from sqlmodel.ext.asyncio.session import AsyncSession
+from utils.auth import get_token_user_id_http
+
+router = APIRouter(prefix='/inbox')
+
+@router.get('')
+async def get_user_inbox(
+    user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
+    before: Annotated[str | None, Query()] = None,
+    limit: Annotated[int, Query(ge=1, le=100)] = 30,
+    session: AsyncSession = Depends(get_read_session),
+) -> InboxPage:
+    try:
+        return await get_inbox(session, user_id, before=before, limit=limit)
+    except BadRequestError as e:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, detail=str(e))
@@ -0,0 +1,24 @@
+from fastapi.responses import PlainTextResponse
+from fastapi.routing import APIRouter
+
+from db.session import pool_stats
+from services.group_commit import group_commit_writer
+from utils.auth import password_hash_pool_stats
+from utils.metrics import registry
+from ws.connection import manager
+
+router = APIRouter()
+
+registry.gauge('ws_connections', 'Open WebSocket connections.', manager.connection_count)
+registry.gauge('ws_connected_users', 'Users with at least one open WebSocket.', lambda: len(manager.active_connections))
+registry.gauge(
+    'password_hash_queue_depth', 'Hash/verify calls waiting for a hashing thread.',
+    lambda: password_hash_pool_stats()['queued'],
+)
+registry.gauge('group_commit_queue_depth', 'Write events waiting for the group-commit writer.', lambda: group_commit_writer.stats()['queued'])
+registry.gauge('db_pool_checked_out', 'Writer pool connections in use.', lambda: pool_stats()['checked_out'])
+
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(registry.render(), media_type='text/plain; version=0.0.4')
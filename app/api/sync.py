@@ -0,0 +1,21 @@
+import uuid
+from typing import Annotated
+
+from fastapi import Depends, Query
+from fastapi.routing import APIRouter
+
+from db.session import get_read_session
+from services.sync import SyncPage, get_sync_page
+from sqlmodel.ext.asyncio.session import AsyncSession
+from utils.auth import get_token_user_id_http
+
+router = APIRouter(prefix='/sync')
+
+@router.get('')
+async def sync(
+    user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
+    since: Annotated[int | None, Query(ge=0)] = None,
+    limit: Annotated[int | None, Query(ge=1)] = None,
+    session: AsyncSession = Depends(get_read_session),
+) -> SyncPage:
+    return await get_sync_page(session, user_id, since=since, limit=limit)
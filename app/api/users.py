@@ -1,24 +1,74 @@
+import uuid
 from typing import Annotated
 
 from fastapi import Depends, HTTPException, Query, status
 from fastapi.routing import APIRouter
+from pydantic import BaseModel
 
-from db.session import get_session
+from db.session import get_read_session
 from schemas import User
-from sqlmodel import Session, select
+from schemas.user import normalize_username
+from sqlalchemy import tuple_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from utils.auth import get_token_user_id_http
 
 router = APIRouter(prefix='/users')
 
+
+class UserInformation(BaseModel):
+    id: str
+    username: str
+    display_name: str | None = None
+
+
+class UserPage(BaseModel):
+    items: list[UserInformation]
+    # Pass back as `after` to get the next page.
+    next_cursor: str | None = None
+
+
 @router.get('/search')
 async def search_user_by_username(
     username: Annotated[str, Query()],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_read_session),
 ):
-    user = session.exec(
+    user = (await session.exec(
         select(User).where(User.username == username)
-    ).first()
+    )).first()
 
     if user is None:
         raise HTTPException(status.HTTP_404_NOT_FOUND, 'User not found')
     
-    return user.model_dump(exclude={'password_hash'})
+    return user.model_dump(exclude={'password_hash', 'username_normalized'})
+
+
+@router.get('/search/prefix')
+async def search_users_by_prefix(
+    user_id: Annotated[uuid.UUID, Depends(get_token_user_id_http)],
+    q: Annotated[str, Query(min_length=1, max_length=50)],
+    after: Annotated[str | None, Query()] = None,
+    limit: Annotated[int, Query(ge=1, le=50)] = 20,
+    session: AsyncSession = Depends(get_read_session),
+) -> UserPage:
+    # A range on the normalized column instead of LIKE, which SQLite would
+    # not serve from ix_users_username_prefix.
+    prefix = normalize_username(q)
+    query = (
+        select(User.id, User.username, User.display_name, User.username_normalized)
+        .where(User.username_normalized >= prefix, User.username_normalized < prefix + '\U0010ffff')
+        .order_by(User.username_normalized, User.username)
+        .limit(limit + 1)
+    )
+    if after is not None:
+        query = query.where(
+            tuple_(User.username_normalized, User.username) > (normalize_username(after), after)
+        )
+
+    rows = (await session.exec(query)).all()
+    items = [
+        UserInformation(id=str(user_id), username=username, display_name=display_name)
+        for user_id, username, display_name, _ in rows[:limit]
+    ]
+    next_cursor = items[-1].username if len(rows) > limit else None
+    return UserPage(items=items, next_cursor=next_cursor)
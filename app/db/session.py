@@ -1,7 +1,27 @@
+import logging
 from pathlib import Path
+from sqlalchemy import bindparam, event, inspect, select, text, update
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlmodel import Session, SQLModel, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from config import (
+    DB_ECHO,
+    DB_MAX_OVERFLOW,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT_S,
+    DB_PROFILE,
+    DB_READER_POOL_SIZE,
+    SQLITE_BUSY_TIMEOUT_MS,
+    SQLITE_CACHE_SIZE_KB,
+    SQLITE_MMAP_SIZE,
+)
 from schemas import *
+from schemas.user import normalize_username
+
+logger = logging.getLogger(__name__)
 
 ROOT = Path(__file__).resolve().parents[2]
 DATA_DIR = ROOT / 'data'
@@ -9,16 +29,215 @@ DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 sqlite_file = DATA_DIR / 'database.db'
 sqlite_url = f'sqlite:///{sqlite_file}'
+async_sqlite_url = f'sqlite+aiosqlite:///{sqlite_file}'
+
+PRODUCTION = DB_PROFILE == 'prod'
+
+if PRODUCTION:
+    _pragmas = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': SQLITE_MMAP_SIZE,
+        'cache_size': -SQLITE_CACHE_SIZE_KB,
+        'busy_timeout': SQLITE_BUSY_TIMEOUT_MS,
+        'temp_store': 'MEMORY',
+    }
+else:
+    _pragmas = {'busy_timeout': SQLITE_BUSY_TIMEOUT_MS}
+
+def _set_pragmas(dbapi_conn, extra: dict | None = None) -> None:
+    cursor = dbapi_conn.cursor()
+    for name, value in {**_pragmas, **(extra or {})}.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
 
+# Sync engine, kept for scripts and one-off maintenance jobs.
 engine = create_engine(
     sqlite_url,
-    echo=True,
+    echo=DB_ECHO,
     connect_args={'check_same_thread': False},
 )
 
+# Bounded pool: at most DB_POOL_SIZE + DB_MAX_OVERFLOW connections, no matter
+# how many sockets are open. Callers wait up to DB_POOL_TIMEOUT_S for a slot.
+# In prod this is the single writer; SQLite only ever runs one write at a
+# time, so more connections would just contend for the lock.
+async_engine = create_async_engine(
+    async_sqlite_url,
+    echo=DB_ECHO,
+    poolclass=AsyncAdaptedQueuePool,
+    pool_size=1 if PRODUCTION else DB_POOL_SIZE,
+    max_overflow=0 if PRODUCTION else DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT_S,
+)
+
+# Readers only exist in prod, where WAL lets them run alongside the writer.
+if PRODUCTION:
+    async_read_engine = create_async_engine(
+        async_sqlite_url,
+        echo=DB_ECHO,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=DB_READER_POOL_SIZE,
+        max_overflow=0,
+        pool_timeout=DB_POOL_TIMEOUT_S,
+    )
+else:
+    async_read_engine = async_engine
+
+def use_explicit_transactions(async_engine_, begin: str = 'BEGIN') -> None:
+    # pysqlite/aiosqlite defer BEGIN until the first DML, which breaks
+    # SAVEPOINT; hand transaction control to SQLAlchemy instead.
+    @event.listens_for(async_engine_.sync_engine, 'connect')
+    def _disable_driver_transactions(dbapi_conn, conn_record):
+        dbapi_conn.isolation_level = None
+
+    @event.listens_for(async_engine_.sync_engine, 'begin')
+    def _begin(conn):
+        conn.exec_driver_sql(begin)
+
+# Group-commit batches use a SAVEPOINT per event, and BEGIN IMMEDIATE takes
+# the write lock up front so a batch never fails halfway on a lock upgrade.
+# In prod they share the single writer connection with REST writes; a second
+# writer would only contend with it for the lock.
+if PRODUCTION:
+    group_commit_engine = async_engine
+else:
+    group_commit_engine = create_async_engine(
+        async_sqlite_url,
+        echo=DB_ECHO,
+        poolclass=AsyncAdaptedQueuePool,
+        pool_size=1,
+        max_overflow=0,
+        pool_timeout=DB_POOL_TIMEOUT_S,
+    )
+use_explicit_transactions(group_commit_engine, 'BEGIN IMMEDIATE')
+
+async_session_maker = async_sessionmaker(
+    async_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
+async_read_session_maker = async_sessionmaker(
+    async_read_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
+group_commit_session_maker = async_sessionmaker(
+    group_commit_engine,
+    class_=AsyncSession,
+    expire_on_commit=False,
+)
+
+_pool_counters = {'connects': 0, 'checkouts': 0, 'checkins': 0}
+
+@event.listens_for(engine, 'connect')
+def _on_sync_connect(dbapi_conn, conn_record):
+    _set_pragmas(dbapi_conn)
+
+@event.listens_for(async_engine.sync_engine, 'connect')
+def _on_connect(dbapi_conn, conn_record):
+    _set_pragmas(dbapi_conn)
+    _pool_counters['connects'] += 1
+
+@event.listens_for(async_engine.sync_engine, 'checkout')
+def _on_checkout(dbapi_conn, conn_record, conn_proxy):
+    _pool_counters['checkouts'] += 1
+
+@event.listens_for(async_engine.sync_engine, 'checkin')
+def _on_checkin(dbapi_conn, conn_record):
+    _pool_counters['checkins'] += 1
+
+if group_commit_engine is not async_engine:
+    @event.listens_for(group_commit_engine.sync_engine, 'connect')
+    def _on_group_commit_connect(dbapi_conn, conn_record):
+        _set_pragmas(dbapi_conn)
+
+if async_read_engine is not async_engine:
+    @event.listens_for(async_read_engine.sync_engine, 'connect')
+    def _on_read_connect(dbapi_conn, conn_record):
+        _set_pragmas(dbapi_conn, {'query_only': 'ON'})
+
+def _engine_pool_stats(async_engine_) -> dict:
+    pool = async_engine_.sync_engine.pool
+    return {
+        'pool_size': pool.size(),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': pool.overflow(),
+    }
+
+def pool_stats() -> dict:
+    stats = {
+        'profile': DB_PROFILE,
+        'max_overflow': 0 if PRODUCTION else DB_MAX_OVERFLOW,
+        **_engine_pool_stats(async_engine),
+        **_pool_counters,
+    }
+    if async_read_engine is not async_engine:
+        stats['readers'] = _engine_pool_stats(async_read_engine)
+    return stats
+
 def init_db():
     SQLModel.metadata.create_all(engine)
 
+# create_all never alters a table that already exists, so columns added to a
+# model later are added here. They must be nullable or have a server default.
+def _add_missing_columns(conn) -> None:
+    inspector = inspect(conn)
+    for table in SQLModel.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            if not column.nullable and column.server_default is None:
+                raise RuntimeError(f'Cannot add NOT NULL column {table.name}.{column.name} without a default')
+            logger.info('Adding column %s.%s', table.name, column.name)
+            conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}'))
+
+# Rows from before username_normalized existed hold the column's '' default.
+def _backfill_username_normalized(conn) -> None:
+    rows = conn.execute(
+        select(User.id, User.username).where(User.username_normalized == '')
+    ).all()
+    if not rows:
+        return
+    logger.info('Backfilling username_normalized for %d users', len(rows))
+    conn.execute(
+        update(User).where(User.id == bindparam('user_id')).values(username_normalized=bindparam('normalized')),
+        [{'user_id': user_id, 'normalized': normalize_username(username)} for user_id, username in rows],
+    )
+
+# Indexes added to a model after its table was created; create_all only
+# creates indexes together with a new table.
+def _create_missing_indexes(conn) -> None:
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+async def init_db_async():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(_add_missing_columns)
+        await conn.run_sync(_backfill_username_normalized)
+        await conn.run_sync(_create_missing_indexes)
+
 def get_session():
     with Session(engine) as session:
         yield session
+
+async def get_async_session():
+    async with async_session_maker() as session:
+        yield session
+
+async def get_read_session():
+    async with async_read_session_maker() as session:
+        yield session
+
+async def dispose_engines() -> None:
+    await async_engine.dispose()
+    if group_commit_engine is not async_engine:
+        await group_commit_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
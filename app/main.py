@@ -6,24 +6,59 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from api import api_router
-from config import RMQ_URL
-from db.session import init_db
+from api.metrics import router as metrics_router
+from config import (
+    REENCRYPT_ENABLED,
+    RMQ_CHANNEL_POOL_SIZE,
+    RMQ_CODEC,
+    RMQ_CONFIRM_BATCH_SIZE,
+    RMQ_CONSUMER_PREFETCH,
+    RMQ_CONSUMER_WORKERS,
+    RMQ_PRESENCE_ROUTING,
+    RMQ_PUBLISHER_CONFIRMS,
+    RMQ_URL,
+)
+from db.session import dispose_engines, init_db_async
 from rabbitmq import RMQConnection, RMQConsumer, RMQPublisher
+from services.group_commit import group_commit_writer
+from services.inbox import backfill_inbox_entries
+from services.outbox import outbox_relay
+from services.presence_routing import PresenceRouter
+from services.reencryption import run_reencryption
+from services.sync import run_sync_retention
 from services.rmq_ws_bridge import rmq_ws_bridge
+from utils.codec import get_codec
 from ws import ws_router
+from ws.connection import manager
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    init_db()
-    app.state.rabbit = RMQConnection(RMQ_URL)
+    if get_codec(RMQ_CODEC) is None:
+        raise RuntimeError(f'Unknown or unavailable RMQ_CODEC: {RMQ_CODEC}')
+    await init_db_async()
+    await backfill_inbox_entries()
+    app.state.rabbit = RMQConnection(
+        RMQ_URL,
+        channel_pool_size=RMQ_CHANNEL_POOL_SIZE,
+        publisher_confirms=RMQ_PUBLISHER_CONFIRMS,
+    )
     await app.state.rabbit.connect()
     await app.state.rabbit.declare_exchange('messages')
-    app.state.message_publisher = RMQPublisher(app.state.rabbit, exchange_name='messages')
+    app.state.message_publisher = RMQPublisher(
+        app.state.rabbit,
+        exchange_name='messages',
+        confirm_batch_size=RMQ_CONFIRM_BATCH_SIZE,
+        codec=get_codec(RMQ_CODEC),
+    )
     app.state.consumers = []
     app.state.consumer_tasks = []
 
-    message_routing_keys = [f'conversation.*.{et}' for et in ('created','edited','deleted','delivered','seen')]
+    # With presence routing the queue starts with only the membership key and
+    # gains conversation.<id>.* bindings as local participants connect.
+    message_routing_keys = ['membership.*']
+    if not RMQ_PRESENCE_ROUTING:
+        message_routing_keys += [f'conversation.*.{et}' for et in ('created','edited','deleted','delivered','seen','batch')]
     queue_name = f'ws_bridge.{uuid.uuid4()}'
 
     message_consumer = RMQConsumer(
@@ -33,20 +68,45 @@ async def lifespan(app: FastAPI):
         exchange_name='messages',
     )
     app.state.consumers.append(message_consumer)
+    if RMQ_PRESENCE_ROUTING:
+        manager.presence = PresenceRouter(message_consumer)
 
     for consumer in app.state.consumers:
-        task = asyncio.create_task(consumer.start_consuming(handler=rmq_ws_bridge))
+        task = asyncio.create_task(consumer.start_consuming(
+            handler=rmq_ws_bridge,
+            prefetch=RMQ_CONSUMER_PREFETCH,
+            workers=RMQ_CONSUMER_WORKERS,
+        ))
         app.state.consumer_tasks.append(task)
 
+    outbox_task = asyncio.create_task(outbox_relay.run(app.state.message_publisher))
+    reencryption_task = asyncio.create_task(run_reencryption()) if REENCRYPT_ENABLED else None
+    sync_retention_task = asyncio.create_task(run_sync_retention())
+
     yield
 
+    # Unpublished rows stay in the outbox for the next start.
+    background_tasks = [outbox_task, sync_retention_task]
+    if reencryption_task is not None:
+        background_tasks.append(reencryption_task)
+    for task in background_tasks:
+        task.cancel()
+
     for consumer in app.state.consumers:
         await consumer.stop_consuming()
 
     for task in app.state.consumer_tasks:
         task.cancel()
+    background_tasks += app.state.consumer_tasks
+
+    # Let cancelled tasks unwind before the publisher and engines they use close.
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await manager.idle_timer.stop()
 
+    await group_commit_writer.close()
+    await app.state.message_publisher.close()
     await app.state.rabbit.close()
+    await dispose_engines()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -65,4 +125,5 @@ app.add_middleware(
 )
 
 app.include_router(api_router)
+app.include_router(metrics_router)
 app.include_router(ws_router)
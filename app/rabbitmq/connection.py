@@ -7,37 +7,87 @@ import aio_pika
 logger = logging.getLogger(__name__)
 
 class RMQConnection:
-    def __init__(self, url: str, loop=None, reconnect_delay: float = 1.0):
+    def __init__(
+            self,
+            url: str,
+            loop=None,
+            reconnect_delay: float = 1.0,
+            channel_pool_size: int = 4,
+            publisher_confirms: bool = True,
+        ):
         self.url = url
         self._conn: Optional[aio_pika.RobustConnection] = None
         self._loop = loop or asyncio.get_event_loop()
         self._reconnect_delay = reconnect_delay
         self._closing = False
-    
+        self._connect_lock = asyncio.Lock()
+
+        # Long-lived channels shared by publishers, handed out round-robin,
+        # each with its own cache of declared exchanges.
+        self.channel_pool_size = channel_pool_size
+        self.publisher_confirms = publisher_confirms
+        self._channels: list[Optional[aio_pika.abc.AbstractChannel]] = [None] * channel_pool_size
+        self._exchanges: list[dict[str, aio_pika.abc.AbstractExchange]] = [{} for _ in range(channel_pool_size)]
+        self._next_channel = 0
+        self._channel_locks = [asyncio.Lock() for _ in range(channel_pool_size)]
+
     async def connect(self) -> None:
-        if self._conn and self._conn.is_closed:
+        if self._conn and not self._conn.is_closed:
             return
-        
-        while not self._closing:
-            try:
-                self._conn = await aio_pika.connect_robust(self.url, loop=self._loop)
-                logger.info('Connected to RabbitMQ')
-                return
-            except Exception as exc:
-                logger.exception(
-                    f'Failed to connect to RabbitMQ, retrying in {self._reconnect_delay:.1f}s'
-                )
-                await asyncio.sleep(self._reconnect_delay)
-    
+
+        async with self._connect_lock:
+            while not self._closing and not (self._conn and not self._conn.is_closed):
+                try:
+                    self._conn = await aio_pika.connect_robust(self.url, loop=self._loop)
+                    logger.info('Connected to RabbitMQ')
+                    return
+                except Exception as exc:
+                    logger.exception(
+                        f'Failed to connect to RabbitMQ, retrying in {self._reconnect_delay:.1f}s'
+                    )
+                    await asyncio.sleep(self._reconnect_delay)
+
     async def close(self) -> None:
         self._closing = True
+        for ch in self._channels:
+            if ch is not None and not ch.is_closed:
+                await ch.close()
         if self._conn:
             await self._conn.close()
-    
+
     async def get_channel(self) -> aio_pika.Channel:
+        # A dedicated channel, for consumers that need their own QoS.
         await self.connect()
         return await self._conn.channel()
-    
+
+    async def get_pooled_channel(self) -> tuple[int, aio_pika.abc.AbstractChannel]:
+        slot = self._next_channel
+        self._next_channel = (slot + 1) % self.channel_pool_size
+
+        ch = self._channels[slot]
+        if ch is not None and not ch.is_closed:
+            return slot, ch
+
+        async with self._channel_locks[slot]:
+            ch = self._channels[slot]
+            if ch is None or ch.is_closed:
+                await self.connect()
+                ch = await self._conn.channel(publisher_confirms=self.publisher_confirms)
+                self._channels[slot] = ch
+                self._exchanges[slot] = {}
+            return slot, ch
+
     async def declare_exchange(self, name: str, type: str = 'topic', durable=True) -> aio_pika.Exchange:
-        ch = await self.get_channel()
-        return await ch.declare_exchange(name, type=type, durable=durable)
+        slot, ch = await self.get_pooled_channel()
+        exchange = self._exchanges[slot].get(name)
+        if exchange is None:
+            exchange = await ch.declare_exchange(name, type=type, durable=durable)
+            self._exchanges[slot][name] = exchange
+        return exchange
+
+    def stats(self) -> dict:
+        return {
+            'channels_open': sum(1 for ch in self._channels if ch is not None and not ch.is_closed),
+            'channel_pool_size': self.channel_pool_size,
+            'exchanges_cached': sum(len(cache) for cache in self._exchanges),
+        }
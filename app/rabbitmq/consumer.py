@@ -1,5 +1,6 @@
+import asyncio
 import logging
-from typing import Callable
+from typing import Callable, Optional
 
 import aio_pika
 
@@ -7,6 +8,13 @@ from .connection import RMQConnection
 
 logger = logging.getLogger(__name__)
 
+
+def conversation_partition_key(message: aio_pika.abc.AbstractIncomingMessage) -> str:
+    # conversation.<id>.<event> and membership.<id> both carry the id second.
+    parts = (message.routing_key or '').split('.')
+    return parts[1] if len(parts) > 1 else ''
+
+
 class RMQConsumer:
     def __init__(
             self,
@@ -20,8 +28,20 @@ class RMQConsumer:
         self.routing_keys = routing_keys
         self.exchange_name = exchange_name
         self._stopping = False
-    
-    async def start_consuming(self, handler: Callable[[aio_pika.IncomingMessage], None], prefetch: int = 10):
+        self._queue: aio_pika.abc.AbstractQueue | None = None
+        self._exchange: aio_pika.abc.AbstractExchange | None = None
+        self._ready = asyncio.Event()
+        self._worker_queues: list[asyncio.Queue] = []
+        self._worker_busy: list[bool] = []
+        self._worker_processed: list[int] = []
+
+    async def start_consuming(
+            self,
+            handler: Callable[[aio_pika.IncomingMessage], None],
+            prefetch: int = 10,
+            workers: int = 0,
+            partition_key: Callable[[aio_pika.IncomingMessage], str] = conversation_partition_key,
+        ):
         await self.conn.connect()
         ch = await self.conn.get_channel()
         await ch.set_qos(prefetch_count=prefetch)
@@ -29,16 +49,75 @@ class RMQConsumer:
         queue = await ch.declare_queue(self.queue_name, durable=True)
         for routing_key in self.routing_keys:
             await queue.bind(exchange, routing_key)
-        
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
-                async with message.process(requeue=False):
-                    try:
-                        await handler(message)
-                    except Exception:
-                        logger.exception('Handler failed')
-                if self._stopping:
-                    break
+        self._queue, self._exchange = queue, exchange
+        self._ready.set()
+
+        if workers <= 0:
+            async with queue.iterator() as queue_iter:
+                async for message in queue_iter:
+                    await self._process(handler, message)
+                    if self._stopping:
+                        break
+            return
+
+        # Messages sharing a partition key go to the same worker, so they are
+        # handled in delivery order while other partitions run in parallel.
+        self._worker_queues = [asyncio.Queue() for _ in range(workers)]
+        self._worker_busy = [False] * workers
+        self._worker_processed = [0] * workers
+        tasks = [asyncio.create_task(self._worker(i, handler)) for i in range(workers)]
+        try:
+            async with queue.iterator() as queue_iter:
+                async for message in queue_iter:
+                    index = hash(partition_key(message)) % workers
+                    self._worker_queues[index].put_nowait(message)
+                    if self._stopping:
+                        break
+            for worker_queue in self._worker_queues:
+                worker_queue.put_nowait(None)
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _process(self, handler, message: aio_pika.IncomingMessage) -> None:
+        async with message.process(requeue=False):
+            try:
+                await handler(message)
+            except Exception:
+                logger.exception('Handler failed')
+
+    async def _worker(self, index: int, handler) -> None:
+        worker_queue = self._worker_queues[index]
+        while True:
+            message: Optional[aio_pika.IncomingMessage] = await worker_queue.get()
+            if message is None:
+                return
+            self._worker_busy[index] = True
+            try:
+                await self._process(handler, message)
+            finally:
+                self._worker_busy[index] = False
+                self._worker_processed[index] += 1
+
+    def stats(self) -> dict:
+        return {
+            'queue': self.queue_name,
+            'workers': [
+                {'queued': worker_queue.qsize(), 'busy': busy, 'processed': processed}
+                for worker_queue, busy, processed in zip(
+                    self._worker_queues, self._worker_busy, self._worker_processed
+                )
+            ],
+        }
 
     async def stop_consuming(self):
         self._stopping = True
+
+    async def bind(self, routing_key: str) -> None:
+        await self._ready.wait()
+        await self._queue.bind(self._exchange, routing_key)
+
+    async def unbind(self, routing_key: str) -> None:
+        await self._ready.wait()
+        await self._queue.unbind(self._exchange, routing_key)
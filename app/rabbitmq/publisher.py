@@ -1,25 +1,139 @@
-import json
+import asyncio
+import logging
 from typing import Any, Optional
 
 import aio_pika
 
+from utils.codec import JSON, Codec
+from utils.metrics import RMQ_PUBLISH_SECONDS
+
 from .connection import RMQConnection
 
+logger = logging.getLogger(__name__)
+
+_publish_seconds = RMQ_PUBLISH_SECONDS.labels('publish')
+_publish_many_seconds = RMQ_PUBLISH_SECONDS.labels('publish_many')
+
 class RMQPublisher:
-    def __init__(self, conn: RMQConnection, exchange_name: str ='messages'):
+    def __init__(
+        self,
+        conn: RMQConnection,
+        exchange_name: str ='messages',
+        confirm_batch_size: int = 0,
+        codec: Codec = JSON,
+    ):
         self.conn = conn
         self.exchange_name = exchange_name
-    
+        self.codec = codec
+
+        # With confirm_batch_size > 0 on a confirming connection, concurrent
+        # publish() calls are buffered while a batch is in flight and the next
+        # batch goes out as soon as its confirms are back (group-commit style).
+        self.confirm_batch_size = confirm_batch_size if conn.publisher_confirms else 0
+        self._pending: list[tuple[str, aio_pika.Message, asyncio.Future]] = []
+        self._flush_wakeup = asyncio.Event()
+        self._flusher_task: asyncio.Task | None = None
+        self.published = 0
+        self.batches = 0
+
     async def ensure_exchange(self) -> aio_pika.Exchange:
         return await self.conn.declare_exchange(self.exchange_name, type='topic', durable=True)
-    
+
+    def _build_message(
+        self,
+        payload: dict | bytes,
+        headers: Optional[dict[str, str]] = None,
+        message_id: Optional[str] = None,
+    ) -> aio_pika.Message:
+        # bytes are an already-encoded body in this publisher's codec.
+        body = payload if isinstance(payload, bytes) else self.codec.dumps(payload)
+        return aio_pika.Message(
+            body,
+            content_type=self.codec.content_type,
+            delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+            headers=headers or {},
+            message_id=message_id,
+        )
+
     async def publish(
         self,
         routing_key: str,
         payload: dict,
         headers: Optional[dict[str, str]] = None
     ) -> None:
-        exchange = await self.ensure_exchange()
-        body = json.dumps(payload).encode()
-        message = aio_pika.Message(body, delivery_mode=aio_pika.DeliveryMode.PERSISTENT, headers=headers or {})
-        await exchange.publish(message=message, routing_key=routing_key)
+        with _publish_seconds.time():
+            await self._publish(routing_key, self._build_message(payload, headers))
+
+    async def _publish(self, routing_key: str, message: aio_pika.Message) -> None:
+        if not self.confirm_batch_size:
+            exchange = await self.ensure_exchange()
+            await exchange.publish(message=message, routing_key=routing_key)
+            self.published += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((routing_key, message, future))
+        if self._flusher_task is None or self._flusher_task.done():
+            self._flusher_task = asyncio.create_task(self._flusher())
+        self._flush_wakeup.set()
+        await future
+
+    async def publish_many(
+        self,
+        items: list[tuple[str, dict | bytes]],
+        headers: Optional[dict[str, str]] = None,
+        message_ids: Optional[list[str]] = None,
+        message_headers: Optional[list[Optional[dict[str, str]]]] = None,
+    ) -> None:
+        # Everything goes out before any confirm is awaited, so the whole
+        # batch costs one confirm round trip instead of one per message.
+        message_ids = message_ids or [None] * len(items)
+        message_headers = message_headers or [None] * len(items)
+        with _publish_many_seconds.time():
+            results = await self._publish_batch([
+                (routing_key, self._build_message(payload, {**(headers or {}), **(extra or {})}, message_id))
+                for (routing_key, payload), message_id, extra in zip(items, message_ids, message_headers)
+            ])
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def close(self) -> None:
+        # Let the flusher drain what is buffered so no caller is left waiting.
+        if self._flusher_task is not None and not self._flusher_task.done():
+            self._flush_wakeup.set()
+            await self._flusher_task
+
+    async def _publish_batch(self, batch: list[tuple[str, aio_pika.Message]]) -> list[Any]:
+        try:
+            exchange = await self.ensure_exchange()
+        except Exception as exc:
+            return [exc] * len(batch)
+
+        results = await asyncio.gather(
+            *(exchange.publish(message=message, routing_key=routing_key) for routing_key, message in batch),
+            return_exceptions=True,
+        )
+        self.batches += 1
+        self.published += sum(1 for result in results if not isinstance(result, BaseException))
+        return results
+
+    async def _flusher(self) -> None:
+        while self._pending:
+            await self._flush_wakeup.wait()
+            self._flush_wakeup.clear()
+
+            batch = self._pending[:self.confirm_batch_size]
+            del self._pending[:self.confirm_batch_size]
+            results = await self._publish_batch([(routing_key, message) for routing_key, message, _ in batch])
+
+            for (_, _, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    future.set_result(None)
+
+            if self._pending:
+                self._flush_wakeup.set()
@@ -3,5 +3,10 @@ from .conversation import Conversation
 from .conversation_participant import ConversationParticipant
 from .message import Message, dump_model
 from .message_receipt import MessageReceipt, ReceiptStatus
+from .inbox_entry import InboxEntry
+from .outbox_event import OutboxEvent
+from .reencryption_checkpoint import ReencryptionCheckpoint
+from .user_event import UserEvent
+from .user_event_retention import UserEventRetention
 
-__all__ = ['User', 'Conversation', 'ConversationParticipant', 'Message', 'MessageReceipt','ReceiptStatus', 'dump_model']
+__all__ = ['User', 'Conversation', 'ConversationParticipant', 'InboxEntry', 'Message', 'MessageReceipt','ReceiptStatus', 'OutboxEvent', 'ReencryptionCheckpoint', 'UserEvent', 'UserEventRetention', 'dump_model']
@@ -16,3 +16,8 @@ class ConversationParticipant(SQLModel, table=True):
     user_id: uuid.UUID = Field(foreign_key='users.id', primary_key=True)
     role: ParticipantRole = Field(default=ParticipantRole.MEMBER)
     joined_at: datetime = Field(default_factory=lambda: datetime.now(tz=UTC))
+
+    # Read watermark: everything up to last_read_created_at counts as seen.
+    last_read_message_id: uuid.UUID | None = None
+    last_read_created_at: datetime | None = None
+    last_read_at: datetime | None = None
@@ -0,0 +1,18 @@
+import uuid
+from datetime import datetime
+
+from sqlalchemy import Index
+from sqlmodel import SQLModel, Field
+
+
+# One row per (participant, conversation), kept current as messages are sent
+# and read so the inbox never has to scan message history.
+class InboxEntry(SQLModel, table=True):
+    __tablename__ = 'inbox_entries'  # type: ignore[assignment]
+    __table_args__ = (Index('ix_inbox_recent', 'user_id', 'last_activity_at', 'conversation_id'),)
+
+    user_id: uuid.UUID = Field(foreign_key='users.id', primary_key=True)
+    conversation_id: uuid.UUID = Field(foreign_key='conversations.id', primary_key=True)
+    last_message_id: uuid.UUID | None = Field(default=None, foreign_key='messages.id')
+    last_activity_at: datetime
+    unread_count: int = 0
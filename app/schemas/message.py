@@ -1,13 +1,16 @@
 import uuid
 from datetime import datetime, UTC
 from sqlmodel import SQLModel, Field
-from sqlalchemy import Column
+from sqlalchemy import Column, Index
 from db.types import EncryptedString
 from schemas.message_out import MessageOut
 from schemas.message_receipt import ReceiptStatus
 
 class Message(SQLModel, table=True):
     __tablename__ = 'messages'
+    __table_args__ = (
+        Index('ix_messages_history', 'conversation_id', 'deleted', 'created_at', 'id'),
+    )
 
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     conversation_id: uuid.UUID = Field(foreign_key='conversations.id', index=True)
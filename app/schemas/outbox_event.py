@@ -0,0 +1,22 @@
+import uuid
+from datetime import datetime, UTC
+
+from sqlmodel import SQLModel, Field
+
+
+# Broker events written in the same transaction as the change they describe
+# and published later by services.outbox.OutboxRelay; rows are deleted once
+# the broker has them.
+class OutboxEvent(SQLModel, table=True):
+    __tablename__ = 'outbox_events'  # type: ignore[assignment]
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id: int | None = Field(default=None, primary_key=True)
+    # Sent as the AMQP message_id so consumers can drop redeliveries.
+    event_id: uuid.UUID = Field(default_factory=uuid.uuid4)
+    routing_key: str
+    # Already-encoded JSON body, published as is.
+    payload: str
+    # The socket whose request produced the event; it already has the result.
+    origin_connection_id: uuid.UUID | None = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
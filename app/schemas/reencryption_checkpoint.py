@@ -0,0 +1,19 @@
+from datetime import datetime
+import uuid
+
+from sqlmodel import SQLModel, Field
+
+
+class ReencryptionCheckpoint(SQLModel, table=True):
+    __tablename__ = 'reencryption_checkpoints'  # type: ignore[assignment]
+
+    # '<table>.<column>', e.g. 'messages.body'.
+    target: str = Field(primary_key=True)
+    # Id of the primary key this pass is re-encrypting onto; a new primary
+    # key restarts the pass from the beginning.
+    key_id: str
+    last_id: uuid.UUID | None = None
+    rows_scanned: int = 0
+    rows_updated: int = 0
+    updated_at: datetime | None = None
+    completed_at: datetime | None = None
@@ -1,12 +1,33 @@
 import uuid
 
 from db.types import EncryptedString 
+from sqlalchemy import Index, event
 from sqlmodel import SQLModel, Field, Column
 
+
+def normalize_username(username: str) -> str:
+    return username.casefold()
+
+
 class User(SQLModel, table=True):
     __tablename__ = 'users'
+    __table_args__ = (
+        # Named indexes rather than column constraints, so init_db_async can
+        # add them to users tables created before they existed.
+        Index('uq_users_username', 'username', unique=True),
+        Index('ix_users_username_prefix', 'username_normalized', 'username'),
+    )
 
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     username: str
+    # Case-folded copy of username, kept in sync on insert/update, for
+    # case-insensitive prefix search as an index range scan.
+    username_normalized: str = Field(default='', sa_column_kwargs={'server_default': ''})
     password_hash: str = Field(sa_column=Column(EncryptedString(), nullable=False))
     display_name: str | None = None
+
+
+@event.listens_for(User, 'before_insert')
+@event.listens_for(User, 'before_update')
+def _sync_username_normalized(mapper, connection, target: User) -> None:
+    target.username_normalized = normalize_username(target.username)
@@ -0,0 +1,24 @@
+import uuid
+from datetime import datetime, UTC
+
+from sqlalchemy import Index
+from sqlmodel import SQLModel, Field
+
+
+# Per-recipient change log for delta sync. seq only ever grows (AUTOINCREMENT
+# never reuses ids), so a client's last seen seq is a complete cursor.
+class UserEvent(SQLModel, table=True):
+    __tablename__ = 'user_events'  # type: ignore[assignment]
+    __table_args__ = (
+        Index('ix_user_events_user_seq', 'user_id', 'seq'),
+        {'sqlite_autoincrement': True},
+    )
+
+    seq: int | None = Field(default=None, primary_key=True)
+    user_id: uuid.UUID = Field(foreign_key='users.id')
+    type: str
+    conversation_id: uuid.UUID = Field(foreign_key='conversations.id')
+    message_id: uuid.UUID | None = Field(default=None, foreign_key='messages.id')
+    # Who caused it; for receipts, the participant who received or read.
+    actor_id: uuid.UUID | None = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(UTC))
@@ -0,0 +1,13 @@
+from datetime import datetime
+
+from sqlmodel import SQLModel, Field
+
+
+# Single row (id=1): every user_events row with seq <= pruned_through_seq has
+# been deleted, so a sync cursor below it can no longer be served.
+class UserEventRetention(SQLModel, table=True):
+    __tablename__ = 'user_event_retention'  # type: ignore[assignment]
+
+    id: int = Field(default=1, primary_key=True)
+    pruned_through_seq: int = 0
+    pruned_at: datetime | None = None
@@ -3,6 +3,15 @@ import uuid
 from sqlmodel import SQLModel, Field
 from datetime import datetime, UTC
 
+MESSAGE_CREATED = 'message.create'
+MESSAGE_EDITED = 'message.edit'
+MESSAGE_DELETED = 'message.delete'
+MESSAGE_DELIVERED = 'message.delivered'
+MESSAGE_SEEN = 'message.seen'
+# Payloads that are a message, stamped with its sender's username. Receipts
+# carry the reader's user_id instead.
+MESSAGE_EVENTS = {MESSAGE_CREATED, MESSAGE_EDITED, MESSAGE_DELETED}
+
 class WSRequest(SQLModel, table=False):
     type: str
     payload: dict
@@ -22,6 +31,15 @@ class WSMessageDelete(SQLModel, table=False):
     id: uuid.UUID
 
 
+class WSBatch(SQLModel, table=False):
+    ops: list[WSRequest] = Field(min_length=1)
+
+
+class WSSync(SQLModel, table=False):
+    since: int | None = Field(default=None, ge=0)
+    limit: int | None = Field(default=None, ge=1)
+
+
 async def handle_ping(ws, payload):
     await ws.send_json({
         'type': 'pong',
@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Awaitable, Callable
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import GROUP_COMMIT_MAX_BATCH, GROUP_COMMIT_MAX_DELAY_MS
+from db.session import group_commit_session_maker
+from utils.metrics import DB_COMMIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+_commit_seconds = DB_COMMIT_SECONDS.labels('group_commit')
+
+Handler = Callable[[AsyncSession, uuid.UUID, dict], Awaitable[dict]]
+
+
+# Queues write events from every connection to a single writer task, which
+# runs each one in its own SAVEPOINT and commits the whole batch at once.
+# A failing event only rolls back its own savepoint; callers get their own
+# result or exception once the shared commit is done.
+class GroupCommitWriter:
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        max_batch: int = GROUP_COMMIT_MAX_BATCH,
+        max_delay_ms: float = GROUP_COMMIT_MAX_DELAY_MS,
+    ):
+        self.session_maker = session_maker
+        self.max_batch = max_batch
+        self.max_delay_s = max_delay_ms / 1000
+        self._queue: asyncio.Queue[tuple[Handler, uuid.UUID, dict, asyncio.Future]] = asyncio.Queue()
+        self._task: asyncio.Task | None = None
+        self.batches = 0
+        self.events = 0
+
+    async def submit(self, handler: Handler, user_id: uuid.UUID, payload: dict) -> dict:
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+        future = loop.create_future()
+        self._queue.put_nowait((handler, user_id, payload, future))
+        return await future
+
+    async def close(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        while not self._queue.empty():
+            *_, future = self._queue.get_nowait()
+            future.cancel()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'events': self.events,
+            'avg_batch': round(self.events / self.batches, 2) if self.batches else 0,
+        }
+
+    async def _collect(self) -> list:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_delay_s
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            # A lone event has nobody to share the commit with; only linger
+            # when other connections are writing too.
+            if len(batch) == 1:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            try:
+                await self._apply(batch)
+            except asyncio.CancelledError:
+                for *_, future in batch:
+                    if not future.done():
+                        future.cancel()
+                raise
+            except Exception as exc:
+                logger.exception('Group commit of %d events failed', len(batch))
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+
+    async def _apply(self, batch: list) -> None:
+        results = []
+        async with self.session_maker() as session:
+            for handler, user_id, payload, future in batch:
+                if future.cancelled():
+                    results.append(None)
+                    continue
+                try:
+                    async with session.begin_nested():
+                        results.append(await handler(session, user_id, payload))
+                except Exception as exc:
+                    results.append(exc)
+            with _commit_seconds.time():
+                await session.commit()
+
+        self.batches += 1
+        self.events += len(batch)
+        for (*_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+group_commit_writer = GroupCommitWriter(group_commit_session_maker)
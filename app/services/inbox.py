@@ -0,0 +1,271 @@
+import logging
+import uuid
+from datetime import datetime
+from typing import Iterable
+
+from pydantic import BaseModel
+from sqlalchemy import and_, case, delete, exists, func, literal, or_, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import desc, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from db.session import async_session_maker
+from schemas import Conversation, ConversationParticipant, InboxEntry, Message, MessageReceipt, ReceiptStatus, User
+import services.messaging as messaging_service
+
+logger = logging.getLogger(__name__)
+
+
+class InboxMessage(BaseModel):
+    id: uuid.UUID
+    sender_id: uuid.UUID
+    sender_username: str
+    body: str | None
+    created_at: datetime
+    deleted: bool
+
+
+class InboxItem(BaseModel):
+    conversation_id: uuid.UUID
+    title: str
+    is_group: bool
+    last_activity_at: datetime
+    unread_count: int
+    last_message: InboxMessage | None = None
+
+
+class InboxPage(BaseModel):
+    items: list[InboxItem]
+    next_cursor: str | None = None
+
+
+async def add_inbox_entries(
+    session: AsyncSession,
+    conversation_id: uuid.UUID,
+    user_ids: Iterable[uuid.UUID],
+    at: datetime,
+) -> None:
+    rows = [
+        {'user_id': user_id, 'conversation_id': conversation_id, 'last_activity_at': at, 'unread_count': 0}
+        for user_id in user_ids
+    ]
+    if rows:
+        await session.execute(sqlite_insert(InboxEntry).values(rows).on_conflict_do_nothing())
+
+
+async def remove_inbox_entry(session: AsyncSession, conversation_id: uuid.UUID, user_id: uuid.UUID) -> None:
+    await session.execute(
+        delete(InboxEntry).where(InboxEntry.conversation_id == conversation_id, InboxEntry.user_id == user_id)
+    )
+
+
+async def record_message(
+    session: AsyncSession,
+    conversation_id: uuid.UUID,
+    message_id: uuid.UUID,
+    sender_id: uuid.UUID,
+    at: datetime,
+) -> None:
+    # One upsert for every participant: bump activity and the preview, and
+    # count the message as unread for everyone but the sender.
+    unread = case((ConversationParticipant.user_id == sender_id, 0), else_=1)
+    stmt = sqlite_insert(InboxEntry).from_select(
+        ['user_id', 'conversation_id', 'last_message_id', 'last_activity_at', 'unread_count'],
+        select(
+            ConversationParticipant.user_id,
+            literal(conversation_id, InboxEntry.conversation_id.type),
+            literal(message_id, InboxEntry.last_message_id.type),
+            literal(at, InboxEntry.last_activity_at.type),
+            unread,
+        ).where(ConversationParticipant.conversation_id == conversation_id),
+    )
+    await session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['user_id', 'conversation_id'],
+            set_={
+                'last_message_id': stmt.excluded.last_message_id,
+                'last_activity_at': stmt.excluded.last_activity_at,
+                'unread_count': InboxEntry.unread_count + stmt.excluded.unread_count,
+            },
+        )
+    )
+
+
+def _is_unread(message_id, created_at):
+    # Whether a participant still counts a message as unread: past their read
+    # watermark or, with no watermark yet, without a SEEN receipt (read state
+    # from before the watermark lives only in receipts).
+    seen = exists().where(
+        MessageReceipt.message_id == message_id,
+        MessageReceipt.user_id == ConversationParticipant.user_id,
+        MessageReceipt.status == ReceiptStatus.SEEN,
+    ).correlate_except(MessageReceipt)
+    return or_(
+        and_(ConversationParticipant.last_read_created_at.is_(None), ~seen),
+        ConversationParticipant.last_read_created_at < created_at,
+    )
+
+
+async def record_message_deleted(session: AsyncSession, message: Message) -> None:
+    # Only participants who were there when it was sent and had not read
+    # past it counted the message.
+    unread_for = select(ConversationParticipant.user_id).where(
+        ConversationParticipant.conversation_id == message.conversation_id,
+        ConversationParticipant.user_id != message.sender_id,
+        ConversationParticipant.joined_at <= message.created_at,
+        _is_unread(message.id, message.created_at),
+    )
+    await session.execute(
+        update(InboxEntry)
+        .where(
+            InboxEntry.conversation_id == message.conversation_id,
+            InboxEntry.user_id.in_(unread_for),
+            InboxEntry.unread_count > 0,
+        )
+        .values(unread_count=InboxEntry.unread_count - 1)
+    )
+
+
+async def backfill_inbox_entries() -> int:
+    # Participants from before inbox_entries was kept have no row; build it
+    # from history once. Rows that exist are never touched, so this is a
+    # no-op after the first run.
+    participant = ConversationParticipant
+    in_conversation = Message.conversation_id == participant.conversation_id
+    last_message = (
+        select(Message.id, Message.created_at)
+        .where(in_conversation)
+        .order_by(desc(Message.created_at), desc(Message.id))
+        .limit(1)
+    )
+    unread = (
+        select(func.count())
+        .select_from(Message)
+        .where(
+            in_conversation,
+            Message.deleted == False,
+            Message.sender_id != participant.user_id,
+            Message.created_at >= participant.joined_at,
+            _is_unread(Message.id, Message.created_at),
+        )
+        .scalar_subquery()
+    )
+    missing = ~exists().where(
+        InboxEntry.user_id == participant.user_id,
+        InboxEntry.conversation_id == participant.conversation_id,
+    )
+    async with async_session_maker() as session:
+        result = await session.execute(
+            sqlite_insert(InboxEntry).from_select(
+                ['user_id', 'conversation_id', 'last_message_id', 'last_activity_at', 'unread_count'],
+                select(
+                    participant.user_id,
+                    participant.conversation_id,
+                    last_message.with_only_columns(Message.id).scalar_subquery(),
+                    func.coalesce(
+                        last_message.with_only_columns(Message.created_at).scalar_subquery(),
+                        participant.joined_at,
+                    ),
+                    unread,
+                ).where(missing),
+            ).on_conflict_do_nothing()
+        )
+        await session.commit()
+    if result.rowcount:
+        logger.info('Backfilled %d inbox entries', result.rowcount)
+    return result.rowcount
+
+
+async def record_read(
+    session: AsyncSession,
+    conversation_id: uuid.UUID,
+    user_id: uuid.UUID,
+    cutoff: datetime,
+) -> None:
+    # Recount from the new watermark, or from when the user joined if that
+    # is later; a range on ix_messages_history.
+    joined_at = (
+        select(ConversationParticipant.joined_at)
+        .where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.user_id == user_id,
+        )
+        .scalar_subquery()
+    )
+    unread = (
+        select(func.count())
+        .select_from(Message)
+        .where(
+            Message.conversation_id == conversation_id,
+            Message.deleted == False,
+            Message.created_at > cutoff,
+            Message.created_at >= joined_at,
+            Message.sender_id != user_id,
+        )
+        .scalar_subquery()
+    )
+    await session.execute(
+        update(InboxEntry)
+        .where(InboxEntry.conversation_id == conversation_id, InboxEntry.user_id == user_id)
+        .values(unread_count=unread)
+    )
+
+
+async def get_inbox(
+    session: AsyncSession,
+    user_id: uuid.UUID,
+    before: str | None = None,
+    limit: int = 30,
+) -> InboxPage:
+    query = (
+        select(
+            InboxEntry.conversation_id,
+            InboxEntry.last_activity_at,
+            InboxEntry.unread_count,
+            Conversation.title,
+            Conversation.is_group,
+            Message.id,
+            Message.sender_id,
+            User.username,
+            Message.body,
+            Message.created_at,
+            Message.deleted,
+        )
+        .join(Conversation, Conversation.id == InboxEntry.conversation_id)
+        .outerjoin(Message, Message.id == InboxEntry.last_message_id)
+        .outerjoin(User, User.id == Message.sender_id)
+        .where(InboxEntry.user_id == user_id, Conversation.deleted == False)
+        .order_by(desc(InboxEntry.last_activity_at), desc(InboxEntry.conversation_id))
+        .limit(limit + 1)
+    )
+    if before:
+        query = query.where(
+            tuple_(InboxEntry.last_activity_at, InboxEntry.conversation_id) < tuple_(*messaging_service.decode_cursor(before))
+        )
+
+    rows = (await session.exec(query)).all()
+    items = []
+    for (conversation_id, last_activity_at, unread_count, title, is_group,
+         message_id, sender_id, username, body, created_at, deleted) in rows[:limit]:
+        item = InboxItem(
+            conversation_id=conversation_id,
+            title=title,
+            is_group=is_group,
+            last_activity_at=last_activity_at,
+            unread_count=unread_count,
+        )
+        if message_id is not None:
+            item.last_message = InboxMessage(
+                id=message_id,
+                sender_id=sender_id,
+                sender_username=username,
+                body=None if deleted else body,
+                created_at=created_at,
+                deleted=deleted,
+            )
+        items.append(item)
+
+    page = InboxPage(items=items)
+    if len(rows) > limit:
+        page.next_cursor = messaging_service.encode_cursor(items[-1].last_activity_at, items[-1].conversation_id)
+    return page
@@ -0,0 +1,108 @@
+import logging
+import uuid
+from typing import Iterable
+
+from sqlmodel import select
+
+from config import MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL_S, USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL_S
+from db.session import async_read_session_maker
+from schemas import ConversationParticipant, User
+from utils.cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+MEMBERSHIP_EVENT = 'membership.changed'
+
+_participants = LRUCache(MEMBERSHIP_CACHE_SIZE, MEMBERSHIP_CACHE_TTL_S)
+_usernames = LRUCache(USERNAME_CACHE_SIZE, USERNAME_CACHE_TTL_S)
+
+# Bumped on every invalidation so a load that raced with one is not cached.
+_generation = 0
+
+
+def membership_routing_key(conversation_id: uuid.UUID) -> str:
+    return f'membership.{conversation_id}'
+
+
+async def get_participant_ids(conversation_id: uuid.UUID) -> tuple[uuid.UUID, ...]:
+    cached = _participants.get(conversation_id)
+    if cached is not None:
+        return cached
+
+    generation = _generation
+    async with async_read_session_maker() as session:
+        participant_ids = tuple((await session.exec(
+            select(ConversationParticipant.user_id)
+            .where(ConversationParticipant.conversation_id == conversation_id)
+        )).all())
+
+    if generation == _generation:
+        _participants.set(conversation_id, participant_ids)
+    return participant_ids
+
+
+async def get_username(user_id: uuid.UUID) -> str | None:
+    cached = _usernames.get(user_id)
+    if cached is not None:
+        return cached
+
+    async with async_read_session_maker() as session:
+        username = (await session.exec(select(User.username).where(User.id == user_id))).first()
+
+    if username is not None:
+        _usernames.set(user_id, username)
+    return username
+
+
+def invalidate_conversation(conversation_id: uuid.UUID) -> None:
+    global _generation
+    _generation += 1
+    _participants.pop(conversation_id)
+
+
+def cache_stats() -> dict:
+    return {'participants': _participants.stats(), 'usernames': _usernames.stats()}
+
+
+async def notify_membership_changed(
+    publisher,
+    conversation_id: uuid.UUID,
+    added: Iterable[uuid.UUID] = (),
+    removed: Iterable[uuid.UUID] = (),
+    deleted: bool = False,
+    presence=None,
+) -> None:
+    invalidate_conversation(conversation_id)
+
+    event = {
+        'type': MEMBERSHIP_EVENT,
+        'payload': {
+            'conversation_id': str(conversation_id),
+            'added': [str(uid) for uid in added],
+            'removed': [str(uid) for uid in removed],
+            'deleted': deleted,
+        },
+    }
+    if presence is not None:
+        # Rebound on this node before the caller returns, so the first
+        # messages in a new conversation cannot reach the exchange before its
+        # routing key is bound here. The broadcast below does the same on the
+        # other nodes and is a no-op on this one.
+        try:
+            await presence.membership_changed(event['payload'])
+        except Exception:
+            logger.exception('Failed to rebind conversation %s', conversation_id)
+    try:
+        await publisher.publish(routing_key=membership_routing_key(conversation_id), payload=event)
+    except Exception:
+        # Other nodes fall back to the TTL if the broadcast is lost.
+        logger.exception('Failed to broadcast membership change for %s', conversation_id)
+
+
+def handle_membership_event(payload: dict) -> None:
+    try:
+        conversation_id = uuid.UUID(str(payload['conversation_id']))
+    except (KeyError, ValueError):
+        logger.warning('Bad membership event: %r', payload)
+        return
+    invalidate_conversation(conversation_id)
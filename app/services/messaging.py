@@ -1,10 +1,17 @@
+import base64
+import binascii
 import json
 import logging
 import uuid
 
 from pydantic import BaseModel
-from sqlmodel import Session, select, desc
+from sqlalchemy import func, insert, literal, or_, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import select, desc
+from sqlmodel.ext.asyncio.session import AsyncSession
 from schemas import ConversationParticipant, Message, MessageReceipt, ReceiptStatus, Conversation, User, dump_model
+import services.inbox as inbox_service
+import services.sync as sync_service
 from datetime import datetime, UTC
 
 logger = logging.getLogger(__name__)
@@ -32,55 +39,78 @@ class MessageInformation(BaseModel):
     created_at: datetime
     edited: bool
 
-def require_conversation(session: Session, conversation_id: uuid.UUID) -> Conversation:
-    conv = session.get(Conversation, conversation_id)
+
+class MessagePage(BaseModel):
+    items: list[MessageInformation]
+    next_cursor: str | None = None
+    prev_cursor: str | None = None
+
+
+def encode_cursor(created_at: datetime, message_id: uuid.UUID) -> str:
+    raw = f'{created_at.isoformat()}|{message_id.hex}'.encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.split('|', 1)
+        return datetime.fromisoformat(created_at), uuid.UUID(message_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise BadRequestError('Invalid cursor') from e
+
+async def require_conversation(session: AsyncSession, conversation_id: uuid.UUID) -> Conversation:
+    conv = await session.get(Conversation, conversation_id)
     if not conv:
         raise NotFoundError('Conversation not found')
     return conv
 
-def is_participant(session: Session, user_id: uuid.UUID, conversation_id: uuid.UUID):
-    participant = session.exec(
+async def is_participant(session: AsyncSession, user_id: uuid.UUID, conversation_id: uuid.UUID):
+    participant = (await session.exec(
         select(ConversationParticipant)
         .where(
             ConversationParticipant.conversation_id == conversation_id,
             ConversationParticipant.user_id == user_id,
         )
-    ).first()
+    )).first()
 
     return bool(participant)
 
-def create_message(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
-    if not is_participant(session, user_id, payload['conversation_id']):
+async def create_message(session: AsyncSession, user_id: uuid.UUID, payload: dict) -> dict:
+    conversation_id = payload['conversation_id']
+    if not await is_participant(session, user_id, conversation_id):
         raise PermissionError('Not a participant')
 
+    now = datetime.now(tz=UTC)
     message = Message(
-        conversation_id=payload['conversation_id'],
+        conversation_id=conversation_id,
         sender_id=user_id,
         body=payload['body'],
+        created_at=now,
     )
     session.add(message)
-    session.commit()
-    session.refresh(message)
-
-    participants: list[uuid.UUID] = session.exec(
-        select(ConversationParticipant.user_id)
-        .where(ConversationParticipant.conversation_id == payload['conversation_id'])
-    ).all()
-
-    now = datetime.now(tz=UTC)
-
-    for participant_user_id in participants:
-        if participant_user_id == user_id:
-            continue
-        session.add(
-            MessageReceipt(
-                message_id=message.id,
-                user_id=participant_user_id,
-                status=ReceiptStatus.DELIVERED,
-                delivered_at=now,
+    await session.flush()
+
+    # Fan receipts out inside the database with one INSERT ... SELECT rather
+    # than one ORM object per participant; everything commits together.
+    await session.execute(
+        insert(MessageReceipt).from_select(
+            ['message_id', 'user_id', 'status', 'delivered_at'],
+            select(
+                literal(message.id, Message.id.type),
+                ConversationParticipant.user_id,
+                literal(ReceiptStatus.DELIVERED, MessageReceipt.status.type),
+                literal(now, MessageReceipt.delivered_at.type),
             )
+            .where(
+                ConversationParticipant.conversation_id == conversation_id,
+                ConversationParticipant.user_id != user_id,
+            ),
         )
-    session.commit()
+    )
+    await inbox_service.record_message(session, conversation_id, message.id, user_id, now)
+    await sync_service.record_event(session, sync_service.MESSAGE_CREATED, conversation_id, now, message.id, user_id)
+    await session.flush()
 
     out = dump_model(message)
     out['status'] = 'DELIVERED'
@@ -88,12 +118,12 @@ def create_message(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
     return out
 
 
-def edit_message(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
-    message = session.get(Message, payload['id'])
+async def edit_message(session: AsyncSession, user_id: uuid.UUID, payload: dict) -> dict:
+    message = await session.get(Message, payload['id'])
     if not message or message.deleted:
         raise NotFoundError('Message not found')
 
-    if not is_participant(session, user_id, message.conversation_id):
+    if not await is_participant(session, user_id, message.conversation_id):
         raise PermissionError('Not a participant')
     
     if message.sender_id != user_id:
@@ -106,21 +136,24 @@ def edit_message(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
     message.body = payload['new_body']
     message.edited = True
     session.add(message)
-    session.commit()
-    session.refresh(message)
+    await session.flush()
+    await sync_service.record_event(
+        session, sync_service.MESSAGE_EDITED, message.conversation_id, datetime.now(tz=UTC), message.id, user_id,
+    )
+    await session.refresh(message)
     return dump_model(message)
 
 
-def delete_message(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
+async def delete_message(session: AsyncSession, user_id: uuid.UUID, payload: dict) -> dict:
     message_id = payload.get('message_id') or payload.get('id')
     if not message_id or not isinstance(message_id, uuid.UUID):
         raise BadRequestError('message_id is required and must be UUID')
 
-    message = session.get(Message, message_id)
+    message = await session.get(Message, message_id)
     if not message or message.deleted:
         raise NotFoundError('Message not found')
 
-    if not is_participant(session, user_id, message.conversation_id):
+    if not await is_participant(session, user_id, message.conversation_id):
         raise PermissionError('Not a participant')
     
     if message.sender_id != user_id:
@@ -128,13 +161,27 @@ def delete_message(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
     
     message.deleted = True
     session.add(message)
-    session.commit()
-    session.refresh(message)
+    await session.flush()
+    await inbox_service.record_message_deleted(session, message)
+    await sync_service.record_event(
+        session, sync_service.MESSAGE_DELETED, message.conversation_id, datetime.now(tz=UTC), message.id, user_id,
+    )
+    await session.refresh(message)
     return dump_model(message)
 
 
-def get_messages(session: Session, conversation_id: uuid.UUID) -> list[MessageInformation]:
-    messages = session.exec(
+async def get_messages(
+    session: AsyncSession,
+    conversation_id: uuid.UUID,
+    before: str | None = None,
+    after: str | None = None,
+    limit: int = 50,
+) -> MessagePage:
+    if before and after:
+        raise BadRequestError('Only one of before/after can be given')
+
+    key = tuple_(Message.created_at, Message.id)
+    query = (
         select(Message.id,
                Message.conversation_id,
                Message.sender_id,
@@ -145,27 +192,50 @@ def get_messages(session: Session, conversation_id: uuid.UUID) -> list[MessageIn
         )
         .where(Message.conversation_id == conversation_id, Message.deleted == False)
         .join(User, User.id == Message.sender_id)
-        .order_by(Message.created_at)
-    ).all()
-    for message in messages:
-        print(message)
-    return list(messages)
-
+    )
 
-def mark_delivered(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
+    # Walk the (conversation_id, deleted, created_at, id) index from the cursor
+    # and fetch one extra row to learn whether another page exists.
+    if after:
+        query = query.where(key > tuple_(*decode_cursor(after))).order_by(Message.created_at, Message.id)
+    else:
+        if before:
+            query = query.where(key < tuple_(*decode_cursor(before)))
+        query = query.order_by(desc(Message.created_at), desc(Message.id))
+
+    rows = list((await session.exec(query.limit(limit + 1))).all())
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not after:
+        rows.reverse()
+
+    items = [MessageInformation.model_validate(row, from_attributes=True) for row in rows]
+    page = MessagePage(items=items)
+    if not items:
+        return page
+
+    first, last = items[0], items[-1]
+    if (has_more and not after) or after:
+        page.prev_cursor = encode_cursor(first.created_at, first.id)
+    if (has_more and after) or before:
+        page.next_cursor = encode_cursor(last.created_at, last.id)
+    return page
+
+
+async def mark_delivered(session: AsyncSession, user_id: uuid.UUID, payload: dict) -> dict:
     message_id: uuid.UUID = payload['message_id']
 
-    message = session.get(Message, message_id)
+    message = await session.get(Message, message_id)
     if not message or message.deleted:
-        raise ValueError('Message not found')
+        raise NotFoundError('Message not found')
 
-    if not is_participant(session, user_id, message.conversation_id):
+    if not await is_participant(session, user_id, message.conversation_id):
         raise PermissionError('Not a participant')
 
     if message.sender_id == user_id:
         raise PermissionError('Sender cannot deliver own message')
 
-    receipt = session.get(MessageReceipt, (message_id, user_id))
+    receipt = await session.get(MessageReceipt, (message_id, user_id))
     if not receipt:
         receipt = MessageReceipt(message_id=message_id, user_id=user_id, status=ReceiptStatus.SENT)
         session.add(receipt)
@@ -183,7 +253,14 @@ def mark_delivered(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
     receipt.status = ReceiptStatus.DELIVERED
     receipt.delivered_at = datetime.now(tz=UTC)
     session.add(receipt)
-    session.commit()
+    await session.flush()
+    # Only the sender cares who received their message; the actor's own
+    # devices get it too. Writing it for every participant would make each
+    # message cost O(participants^2) rows.
+    await sync_service.record_event(
+        session, sync_service.MESSAGE_DELIVERED, message.conversation_id, receipt.delivered_at, message_id, user_id,
+        user_ids=(message.sender_id, user_id),
+    )
 
     return {
         'message_id': str(message_id),
@@ -194,7 +271,7 @@ def mark_delivered(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
     }
 
     
-def mark_seen(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
+async def mark_seen(session: AsyncSession, user_id: uuid.UUID, payload: dict) -> dict:
     conversation_id = payload.get('conversation_id')
     last_seen_message_id = payload.get('last_seen_message_id')
 
@@ -203,76 +280,98 @@ def mark_seen(session: Session, user_id: uuid.UUID, payload: dict) -> dict:
     if not last_seen_message_id or not isinstance(last_seen_message_id, uuid.UUID):
         raise BadRequestError('last_seen_message_id is required and must be UUID')
 
-    require_conversation(session, conversation_id)
+    await require_conversation(session, conversation_id)
 
-    if not is_participant(session, user_id, conversation_id):
+    participant = await session.get(ConversationParticipant, (conversation_id, user_id))
+    if not participant:
         raise PermissionError('Not a participant')
 
-    last_msg = session.get(Message, last_seen_message_id)
-    if not last_msg or last_msg.conversation_id != conversation_id:
-        raise ValueError('Invalid last_seen_message_id')
+    last_msg = await session.get(Message, last_seen_message_id)
+    if not last_msg:
+        raise NotFoundError('Message not found')
+    if last_msg.conversation_id != conversation_id:
+        raise BadRequestError('last_seen_message_id is not in this conversation')
 
     cutoff = last_msg.created_at
+    previous = participant.last_read_created_at
     now = datetime.now(tz=UTC)
 
-    if last_msg.sender_id == user_id:
-        prev_other = session.exec(
-            select(Message)
-            .where(
-                Message.conversation_id == conversation_id,
-                Message.deleted == False,
-                Message.created_at <= cutoff,
-                Message.sender_id != user_id,
-            )
-            .order_by(Message.created_at.desc())
-            .limit(1)
-        ).first()
-
-        if not prev_other:
-            return {
-                'conversation_id': str(conversation_id),
-                'user_id': str(user_id),
-                'status': 'SEEN',
-                'last_seen_message_id': str(last_seen_message_id),
-                'seen_at': now.isoformat(),
-                'updated_count': 0,
-            }
-
-        cutoff = prev_other.created_at
-
-    message_ids = session.exec(
-        select(Message.id)
-        .where(
-            Message.conversation_id == conversation_id,
-            Message.deleted == False,
-            Message.created_at <= cutoff,
-            Message.sender_id != user_id,
-        )
-    ).all()
-
-    updated = 0
-    for mid in message_ids:
-        receipt = session.get(MessageReceipt, (mid, user_id))
-        if not receipt:
-            receipt = MessageReceipt(message_id=mid, user_id=user_id, status=ReceiptStatus.SENT)
-            session.add(receipt)
-
-        if receipt.status != ReceiptStatus.SEEN:
-            receipt.status = ReceiptStatus.SEEN
-            receipt.seen_at = now
-            if receipt.delivered_at is None:
-                receipt.delivered_at = now
-            updated += 1
-
-        session.add(receipt)
-
-    session.commit()
-
-    return {
+    result = {
         'conversation_id': str(conversation_id),
         'user_id': str(user_id),
         'status': 'SEEN',
         'last_seen_message_id': str(last_seen_message_id),
         'seen_at': now.isoformat(),
-        'updated_count': updated,
+        'updated_count': 0,
     }
+
+    # The watermark only moves forward; the WHERE clause keeps concurrent
+    # mark_seen calls from rewinding it.
+    moved = await session.execute(
+        update(ConversationParticipant)
+        .where(
+            ConversationParticipant.conversation_id == conversation_id,
+            ConversationParticipant.user_id == user_id,
+            or_(
+                ConversationParticipant.last_read_created_at.is_(None),
+                ConversationParticipant.last_read_created_at < cutoff,
+            ),
+        )
+        .values(
+            last_read_message_id=last_seen_message_id,
+            last_read_created_at=cutoff,
+            last_read_at=now,
+        )
+    )
+    if not moved.rowcount:
+        return result
+
+    # Per-message receipts are only touched between the old and new watermark.
+    in_window = [
+        Message.conversation_id == conversation_id,
+        Message.deleted == False,
+        Message.created_at <= cutoff,
+        Message.sender_id != user_id,
+    ]
+    if previous is not None:
+        in_window.append(Message.created_at >= previous)
+    window = select(Message.id).where(*in_window)
+
+    receipts = await session.execute(
+        update(MessageReceipt)
+        .where(
+            MessageReceipt.user_id == user_id,
+            MessageReceipt.status != ReceiptStatus.SEEN,
+            MessageReceipt.message_id.in_(window),
+        )
+        .values(
+            status=ReceiptStatus.SEEN,
+            seen_at=now,
+            delivered_at=func.coalesce(MessageReceipt.delivered_at, now),
+        )
+    )
+    # Receipts are created lazily, so messages never marked delivered may
+    # have none yet; give those a SEEN one.
+    created = await session.execute(
+        sqlite_insert(MessageReceipt).from_select(
+            ['message_id', 'user_id', 'status', 'delivered_at', 'seen_at'],
+            select(
+                Message.id,
+                literal(user_id, MessageReceipt.user_id.type),
+                literal(ReceiptStatus.SEEN, MessageReceipt.status.type),
+                literal(now, MessageReceipt.delivered_at.type),
+                literal(now, MessageReceipt.seen_at.type),
+            ).where(*in_window),
+        ).on_conflict_do_nothing()
+    )
+    await inbox_service.record_read(session, conversation_id, user_id, cutoff)
+    # The read marker goes to the reader and to whoever sent the messages
+    # it covers, not to every participant.
+    senders = (await session.execute(select(Message.sender_id).where(*in_window).distinct())).scalars().all()
+    await sync_service.record_event(
+        session, sync_service.MESSAGE_SEEN, conversation_id, now, last_seen_message_id, user_id,
+        user_ids=(user_id, *senders),
+    )
+
+    result['updated_count'] = receipts.rowcount + created.rowcount
+    return result
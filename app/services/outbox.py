@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import uuid
+
+from sqlalchemy import delete
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL_S, OUTBOX_RETRY_MAX_S
+from db.session import async_session_maker
+from rabbitmq import RMQPublisher
+from schemas import OutboxEvent
+from utils.codec import JSON, codec_for_content_type
+
+logger = logging.getLogger(__name__)
+
+# Rows are stored as JSON whatever the broker codec is.
+_json = codec_for_content_type(JSON.content_type)
+
+# Carries OutboxEvent.origin_connection_id so the bridge can skip that socket.
+ORIGIN_CONNECTION_HEADER = 'x-origin-connection'
+
+
+def enqueue_event(
+    session: AsyncSession,
+    routing_key: str,
+    event: dict,
+    origin_connection_id: uuid.UUID | None = None,
+) -> OutboxEvent:
+    # Committed (or rolled back) together with whatever the caller changed.
+    row = OutboxEvent(
+        routing_key=routing_key,
+        payload=_json.dumps(event).decode(),
+        origin_connection_id=origin_connection_id,
+    )
+    session.add(row)
+    return row
+
+
+# Drains outbox_events to the broker in id order. Rows are deleted only after
+# publish_many has all their confirms, so a crash or broker error in between
+# publishes them again: delivery is at-least-once and consumers dedupe on the
+# message_id. The session is never held open across the publish.
+class OutboxRelay:
+    def __init__(
+        self,
+        session_maker: async_sessionmaker,
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        poll_interval_s: float = OUTBOX_POLL_INTERVAL_S,
+        retry_max_s: float = OUTBOX_RETRY_MAX_S,
+    ):
+        self.session_maker = session_maker
+        self.batch_size = batch_size
+        self.poll_interval_s = poll_interval_s
+        self.retry_max_s = retry_max_s
+        self._wakeup: asyncio.Event | None = None
+        self.published = 0
+        self.batches = 0
+        self.failures = 0
+
+    def notify(self) -> None:
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def stats(self) -> dict:
+        return {'published': self.published, 'batches': self.batches, 'failures': self.failures}
+
+    async def run(self, publisher: RMQPublisher) -> None:
+        self._wakeup = asyncio.Event()
+        retry_s = 0.0
+        while True:
+            self._wakeup.clear()
+            try:
+                sent = await self.relay_batch(publisher)
+            except Exception:
+                self.failures += 1
+                retry_s = min(max(retry_s * 2, 0.1), self.retry_max_s)
+                logger.exception('Outbox relay failed, retrying in %.1fs', retry_s)
+                await asyncio.sleep(retry_s)
+                continue
+
+            retry_s = 0.0
+            if sent == self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval_s)
+            except asyncio.TimeoutError:
+                pass
+
+    async def relay_batch(self, publisher: RMQPublisher) -> int:
+        async with self.session_maker() as session:
+            rows = (await session.exec(
+                select(OutboxEvent).order_by(OutboxEvent.id).limit(self.batch_size)
+            )).all()
+        if not rows:
+            return 0
+
+        if publisher.codec.content_type == JSON.content_type:
+            items = [(row.routing_key, row.payload.encode()) for row in rows]
+        else:
+            items = [(row.routing_key, _json.loads(row.payload)) for row in rows]
+        await publisher.publish_many(
+            items,
+            message_ids=[str(row.event_id) for row in rows],
+            message_headers=[
+                {ORIGIN_CONNECTION_HEADER: str(row.origin_connection_id)} if row.origin_connection_id else None
+                for row in rows
+            ],
+        )
+
+        async with self.session_maker() as session:
+            await session.execute(delete(OutboxEvent).where(OutboxEvent.id.in_([row.id for row in rows])))
+            await session.commit()
+
+        self.published += len(rows)
+        self.batches += 1
+        return len(rows)
+
+
+outbox_relay = OutboxRelay(async_session_maker)
@@ -0,0 +1,174 @@
+import asyncio
+import logging
+import uuid
+
+from sqlmodel import select
+
+from db.session import async_read_session_maker
+from rabbitmq import RMQConsumer
+from schemas import Conversation, ConversationParticipant
+
+logger = logging.getLogger(__name__)
+
+
+def conversation_binding_key(conversation_id: uuid.UUID) -> str:
+    return f'conversation.{conversation_id}.*'
+
+
+async def load_user_conversation_ids(user_id: uuid.UUID) -> set[uuid.UUID]:
+    async with async_read_session_maker() as session:
+        rows = (await session.exec(
+            select(ConversationParticipant.conversation_id)
+            .join(Conversation, Conversation.id == ConversationParticipant.conversation_id)
+            .where(ConversationParticipant.user_id == user_id, Conversation.deleted == False)
+        )).all()
+    return set(rows)
+
+
+# Binds this node's bridge queue only to conversations that have a locally
+# connected participant, reference-counted per conversation. Called once per
+# socket: a user's conversations stay bound while any of their sockets is.
+class PresenceRouter:
+    def __init__(self, consumer: RMQConsumer):
+        self.consumer = consumer
+        self._user_conversations: dict[uuid.UUID, set[uuid.UUID]] = {}
+        self._refcounts: dict[uuid.UUID, int] = {}
+        self._sockets: dict[uuid.UUID, int] = {}
+        # One load-and-bind per user; sockets opened meanwhile wait on it.
+        self._binding: dict[uuid.UUID, asyncio.Future] = {}
+        # Membership changes (conversation -> added) that arrived while the
+        # user's conversations were loading, applied once they are loaded.
+        self._pending_changes: dict[uuid.UUID, dict[uuid.UUID, bool]] = {}
+        # Refcounts change synchronously, so they never interleave. Broker
+        # calls for the same key are queued behind each other, so binds and
+        # unbinds land in the order its refcount changed; different keys go
+        # out concurrently. Values are [lock, calls queued on it].
+        self._key_locks: dict[uuid.UUID, list] = {}
+
+    def bound_conversations(self) -> int:
+        return len(self._refcounts)
+
+    async def user_online(self, user_id: uuid.UUID) -> None:
+        # Returns once the user's conversations are bound.
+        self._sockets[user_id] = self._sockets.get(user_id, 0) + 1
+        binding = self._binding.get(user_id)
+        if binding is None:
+            if user_id in self._user_conversations:
+                return
+            self._pending_changes[user_id] = {}
+            binding = self._binding[user_id] = asyncio.ensure_future(self._bind_user(user_id))
+            binding.add_done_callback(lambda _: self._binding.pop(user_id, None))
+        await asyncio.shield(binding)
+
+    async def user_offline(self, user_id: uuid.UUID) -> None:
+        count = self._sockets.get(user_id, 0) - 1
+        if count > 0:
+            self._sockets[user_id] = count
+            return
+        self._sockets.pop(user_id, None)
+        conversation_ids = self._user_conversations.pop(user_id, set())
+        await self._apply((), self._release(conversation_ids))
+
+    async def _bind_user(self, user_id: uuid.UUID) -> None:
+        try:
+            conversation_ids = await load_user_conversation_ids(user_id)
+        finally:
+            changes = self._pending_changes.pop(user_id)
+
+        if user_id not in self._sockets:
+            # Every socket closed while we were loading.
+            return
+        for conversation_id, added in changes.items():
+            if added:
+                conversation_ids.add(conversation_id)
+            else:
+                conversation_ids.discard(conversation_id)
+        self._user_conversations[user_id] = set()
+        to_bind = self._acquire(user_id, conversation_ids)
+        await self._apply(to_bind, ())
+        # Keys another socket's bind is still in flight for are not bound yet either.
+        await asyncio.gather(*(
+            self._broker_call(None, conversation_id)
+            for conversation_id in conversation_ids.difference(to_bind) & self._key_locks.keys()
+        ))
+
+    async def membership_changed(self, payload: dict) -> None:
+        try:
+            conversation_id = uuid.UUID(str(payload['conversation_id']))
+            added = {uuid.UUID(str(uid)) for uid in payload.get('added', ())}
+            removed = {uuid.UUID(str(uid)) for uid in payload.get('removed', ())}
+        except (KeyError, ValueError):
+            logger.warning('Bad membership event: %r', payload)
+            return
+
+        if payload.get('deleted'):
+            removed |= {
+                uid for uid, conversations in self._user_conversations.items()
+                if conversation_id in conversations
+            }
+            removed |= self._pending_changes.keys()
+
+        for user_id in added & self._pending_changes.keys():
+            self._pending_changes[user_id][conversation_id] = True
+        for user_id in removed & self._pending_changes.keys():
+            self._pending_changes[user_id][conversation_id] = False
+
+        to_bind, to_unbind = [], []
+        for user_id in added:
+            if user_id in self._user_conversations:
+                to_bind += self._acquire(user_id, {conversation_id})
+        for user_id in removed:
+            conversations = self._user_conversations.get(user_id)
+            if conversations is not None and conversation_id in conversations:
+                conversations.discard(conversation_id)
+                to_unbind += self._release({conversation_id})
+        await self._apply(to_bind, to_unbind)
+
+    def _acquire(self, user_id: uuid.UUID, conversation_ids: set[uuid.UUID]) -> list[uuid.UUID]:
+        conversations = self._user_conversations[user_id]
+        first_refs = []
+        for conversation_id in conversation_ids - conversations:
+            conversations.add(conversation_id)
+            self._refcounts[conversation_id] = self._refcounts.get(conversation_id, 0) + 1
+            if self._refcounts[conversation_id] == 1:
+                first_refs.append(conversation_id)
+        return first_refs
+
+    def _release(self, conversation_ids: set[uuid.UUID]) -> list[uuid.UUID]:
+        last_refs = []
+        for conversation_id in conversation_ids:
+            count = self._refcounts.get(conversation_id, 0) - 1
+            if count > 0:
+                self._refcounts[conversation_id] = count
+            else:
+                self._refcounts.pop(conversation_id, None)
+                last_refs.append(conversation_id)
+        return last_refs
+
+    async def _apply(self, to_bind, to_unbind) -> None:
+        if not to_bind and not to_unbind:
+            return
+        # gather() starts the calls in this order before anything else runs,
+        # so each takes its key's lock in refcount order.
+        results = await asyncio.gather(
+            *(self._broker_call(self.consumer.bind, conversation_id) for conversation_id in to_bind),
+            *(self._broker_call(self.consumer.unbind, conversation_id) for conversation_id in to_unbind),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _broker_call(self, call, conversation_id: uuid.UUID) -> None:
+        entry = self._key_locks.get(conversation_id)
+        if entry is None:
+            entry = self._key_locks[conversation_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                if call is not None:
+                    await call(conversation_binding_key(conversation_id))
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._key_locks[conversation_id]
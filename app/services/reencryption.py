@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, UTC
+
+from sqlalchemy import String, bindparam, select, type_coerce, update
+from sqlalchemy.sql.schema import Column
+
+from config import REENCRYPT_BATCH_SIZE, REENCRYPT_RETRY_MAX_S, REENCRYPT_ROWS_PER_S
+from db.session import async_session_maker
+from schemas import Message, ReencryptionCheckpoint, User
+from utils.crypto import is_current, primary_key_id, reencrypt_str
+
+logger = logging.getLogger(__name__)
+
+# Encrypted columns, read and written as raw ciphertext so EncryptedString
+# does not decrypt on load or re-encrypt on bind.
+REENCRYPT_TARGETS: list[Column] = [
+    Message.__table__.c.body,
+    User.__table__.c.password_hash,
+]
+
+
+def target_name(column: Column) -> str:
+    return f'{column.table.name}.{column.name}'
+
+
+async def load_checkpoint(session, column: Column) -> ReencryptionCheckpoint:
+    key_id = primary_key_id()
+    checkpoint = await session.get(ReencryptionCheckpoint, target_name(column))
+    if checkpoint is None:
+        checkpoint = ReencryptionCheckpoint(target=target_name(column), key_id=key_id)
+        session.add(checkpoint)
+    elif checkpoint.key_id != key_id:
+        checkpoint.key_id = key_id
+        checkpoint.last_id = None
+        checkpoint.rows_scanned = 0
+        checkpoint.rows_updated = 0
+        checkpoint.completed_at = None
+    return checkpoint
+
+
+async def reencrypt_batch(column: Column, batch_size: int) -> tuple[int, bool]:
+    table = column.table
+    raw = type_coerce(column, String)
+
+    # One short transaction per batch: read the next page by id, rewrite the
+    # rows still on an old key, and move the checkpoint, all in one commit.
+    async with async_session_maker() as session:
+        checkpoint = await load_checkpoint(session, column)
+        if checkpoint.completed_at is not None:
+            return 0, True
+
+        query = select(table.c.id, raw).order_by(table.c.id).limit(batch_size)
+        if checkpoint.last_id is not None:
+            query = query.where(table.c.id > checkpoint.last_id)
+        rows = (await session.execute(query)).all()
+
+        updates = [
+            {'b_id': row_id, 'b_old': value, 'b_new': reencrypt_str(value)}
+            for row_id, value in rows
+            if value is not None and not is_current(value)
+        ]
+        if updates:
+            # Matching on the old ciphertext skips rows edited since we read them;
+            # their new value is already on the primary key.
+            await session.execute(
+                update(table)
+                .where(table.c.id == bindparam('b_id'), raw == bindparam('b_old'))
+                .values({column.name: type_coerce(bindparam('b_new'), String)}),
+                updates,
+            )
+
+        now = datetime.now(UTC)
+        checkpoint.rows_scanned += len(rows)
+        checkpoint.rows_updated += len(updates)
+        checkpoint.updated_at = now
+        if rows:
+            checkpoint.last_id = rows[-1][0]
+        if len(rows) < batch_size:
+            checkpoint.completed_at = now
+        session.add(checkpoint)
+        await session.commit()
+        return len(rows), checkpoint.completed_at is not None
+
+
+async def reencrypt_column(
+    column: Column,
+    batch_size: int = REENCRYPT_BATCH_SIZE,
+    rows_per_s: float = REENCRYPT_ROWS_PER_S,
+) -> None:
+    name = target_name(column)
+    started = time.monotonic()
+    scanned = 0
+    while True:
+        count, done = await reencrypt_batch(column, batch_size)
+        scanned += count
+        if done:
+            logger.info('Re-encryption of %s complete (%d rows scanned this run)', name, scanned)
+            return
+
+        # Throttle to rows_per_s so the job never hogs the writer.
+        if rows_per_s > 0:
+            ahead = scanned / rows_per_s - (time.monotonic() - started)
+            if ahead > 0:
+                await asyncio.sleep(ahead)
+
+
+async def run_reencryption() -> None:
+    for column in REENCRYPT_TARGETS:
+        retry_s = 0.0
+        while True:
+            try:
+                await reencrypt_column(column)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                retry_s = min(max(retry_s * 2, 1.0), REENCRYPT_RETRY_MAX_S)
+                logger.exception(
+                    'Re-encryption of %s failed; resuming from its checkpoint in %.0fs', target_name(column), retry_s,
+                )
+                await asyncio.sleep(retry_s)
+
@@ -1,16 +1,28 @@
-import json
 import logging
+import time
 import uuid
 
 import aio_pika
-from sqlmodel import Session, select
 
-from db.session import get_session
-from schemas import ConversationParticipant, User
-from ws.connection import manager
+from config import OUTBOX_DEDUP_CACHE_SIZE
+from schemas.ws import MESSAGE_EVENTS
+from services.outbox import ORIGIN_CONNECTION_HEADER
+from services.membership_cache import MEMBERSHIP_EVENT, get_participant_ids, get_username, handle_membership_event
+from utils.cache import LRUCache
+from utils.codec import codec_for_content_type
+from utils.metrics import BRIDGE_HANDLE_SECONDS, FANOUT_SOCKETS
+from ws.connection import coalesce_key, manager
 
 logger = logging.getLogger(__name__)
 
+# The outbox relay is at-least-once; ids of recently bridged events let a
+# redelivered one be dropped instead of reaching clients twice.
+_bridged_event_ids = LRUCache(OUTBOX_DEDUP_CACHE_SIZE)
+
+
+def bridge_dedup_stats() -> dict:
+    return _bridged_event_ids.stats()
+
 
 def _extract_conversation_id(payload: dict) -> uuid.UUID | None:
     cid = payload.get('conversation_id')
@@ -24,8 +36,7 @@ def _extract_conversation_id(payload: dict) -> uuid.UUID | None:
         return None
 
 
-def _extract_actor_id(payload: dict) -> uuid.UUID | None:
-    raw = payload.get('sender_id') or payload.get('user_id')
+def _parse_uuid(raw) -> uuid.UUID | None:
     if not raw:
         return None
     try:
@@ -35,8 +46,23 @@ def _extract_actor_id(payload: dict) -> uuid.UUID | None:
 
 
 async def rmq_ws_bridge(inc_message: aio_pika.IncomingMessage) -> None:
+    started = time.perf_counter()
     try:
-        data = json.loads(inc_message.body.decode())
+        event_id = inc_message.message_id
+        if event_id is not None:
+            if _bridged_event_ids.get(event_id):
+                logger.debug('Dropping duplicate event %s', event_id)
+                return
+            _bridged_event_ids.set(event_id, True)
+
+        codec = codec_for_content_type(inc_message.content_type)
+        if codec is None:
+            logger.warning('Unsupported RMQ content type: %r', inc_message.content_type)
+            return
+        data = codec.loads(inc_message.body)
+        if not isinstance(data, dict):
+            logger.warning('Bad RMQ message format: %r', data)
+            return
         event_type = data.get('type')
         payload = data.get('payload')
 
@@ -44,32 +70,43 @@ async def rmq_ws_bridge(inc_message: aio_pika.IncomingMessage) -> None:
             logger.warning('Bad RMQ message format: %r', data)
             return
 
+        if event_type == MEMBERSHIP_EVENT:
+            handle_membership_event(payload)
+            if manager.presence is not None:
+                await manager.presence.membership_changed(payload)
+            return
+
         conversation_id = _extract_conversation_id(payload)
         if conversation_id is None:
             logger.warning('No conversation_id in payload for event=%s payload=%r', event_type, payload)
             return
 
-        actor_id = _extract_actor_id(payload)
-
-        session_gen = get_session()
-        session: Session = next(session_gen)
-        try:
-            participant_ids: list[uuid.UUID] = session.exec(
-                select(ConversationParticipant.user_id)
-                .where(ConversationParticipant.conversation_id == conversation_id)
-            ).all()
-
-            sender_username = session.get(User, actor_id).username
-            payload['sender_username'] = sender_username
-        finally:
-            session.close()
-
-        out = {'type': event_type, 'payload': payload}
-
-        for uid in participant_ids:
-            if actor_id is not None and uid == actor_id:
-                continue
-            await manager.send_to_user(out, uid)
+        actor_id = _parse_uuid(payload.get('sender_id') or payload.get('user_id'))
+        # Only the socket that made the change already has it; the actor's
+        # other sockets (other devices) still get the event.
+        origin_connection_id = _parse_uuid((inc_message.headers or {}).get(ORIGIN_CONNECTION_HEADER))
+
+        participant_ids = await get_participant_ids(conversation_id)
+
+        # Message events are published with sender_username already, so the
+        # broker body is forwarded byte-for-byte to sockets on the same wire
+        # format. One from an older publisher is stamped here and re-encoded
+        # once per format.
+        frames = {}
+        if event_type in MESSAGE_EVENTS and actor_id is not None and 'sender_username' not in payload:
+            payload['sender_username'] = await get_username(actor_id)
+        else:
+            frames[codec.content_type] = codec.frame_from_bytes(inc_message.body)
+
+        FANOUT_SOCKETS.observe(manager.fan_out(
+            data,
+            participant_ids,
+            key=coalesce_key(data),
+            exclude_connection=origin_connection_id,
+            frames=frames,
+        ))
 
     except Exception:
         logger.exception('Failed to bridge RMQ to WS')
+    finally:
+        BRIDGE_HANDLE_SECONDS.observe(time.perf_counter() - started)
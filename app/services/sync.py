@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timedelta, UTC
+from typing import Iterable
+
+from pydantic import BaseModel
+from sqlalchemy import delete, func, insert, literal
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import SYNC_MAX_PAGE_SIZE, SYNC_PRUNE_BATCH_SIZE, SYNC_PRUNE_INTERVAL_S, SYNC_RETENTION_DAYS
+from db.session import async_session_maker
+from schemas import ConversationParticipant, Message, UserEvent, UserEventRetention
+from schemas.message_out import MessageOut
+from schemas.ws import MESSAGE_CREATED, MESSAGE_DELETED, MESSAGE_DELIVERED, MESSAGE_EDITED, MESSAGE_SEEN
+
+logger = logging.getLogger(__name__)
+
+
+class SyncEvent(BaseModel):
+    seq: int
+    type: str
+    conversation_id: uuid.UUID
+    actor_id: uuid.UUID | None = None
+    created_at: datetime
+    # Current state of the message, not a snapshot from when the event
+    # happened; the body is withheld once the message is deleted.
+    message: MessageOut | None = None
+
+
+class SyncPage(BaseModel):
+    events: list[SyncEvent]
+    # Pass as `since` next time; covers everything up to here.
+    next_since: int
+    has_more: bool = False
+    # `since` is older than the retention window: events were pruned, so the
+    # client has to reload its state and continue from next_since.
+    reset_required: bool = False
+
+
+async def record_event(
+    session: AsyncSession,
+    type: str,
+    conversation_id: uuid.UUID,
+    at: datetime,
+    message_id: uuid.UUID | None = None,
+    actor_id: uuid.UUID | None = None,
+    user_ids: Iterable[uuid.UUID] | None = None,
+) -> None:
+    if user_ids is not None:
+        rows = [
+            {
+                'user_id': user_id,
+                'type': type,
+                'conversation_id': conversation_id,
+                'message_id': message_id,
+                'actor_id': actor_id,
+                'created_at': at,
+            }
+            for user_id in set(user_ids)
+        ]
+        if rows:
+            await session.execute(insert(UserEvent).values(rows))
+        return
+
+    # One row per participant, written by a single INSERT ... SELECT.
+    await session.execute(
+        insert(UserEvent).from_select(
+            ['user_id', 'type', 'conversation_id', 'message_id', 'actor_id', 'created_at'],
+            select(
+                ConversationParticipant.user_id,
+                literal(type, UserEvent.type.type),
+                literal(conversation_id, UserEvent.conversation_id.type),
+                literal(message_id, UserEvent.message_id.type),
+                literal(actor_id, UserEvent.actor_id.type),
+                literal(at, UserEvent.created_at.type),
+            ).where(ConversationParticipant.conversation_id == conversation_id),
+        )
+    )
+
+
+async def get_head(session: AsyncSession, user_id: uuid.UUID) -> int:
+    head = (await session.exec(
+        select(func.max(UserEvent.seq)).where(UserEvent.user_id == user_id)
+    )).first()
+    return head or 0
+
+
+async def prune_events(before: datetime, batch_size: int = SYNC_PRUNE_BATCH_SIZE) -> int:
+    # seq grows with created_at, so everything up to the newest expired seq
+    # goes, in short batches so the writer is never held for long.
+    async with async_session_maker() as session:
+        through = (await session.exec(
+            select(func.max(UserEvent.seq)).where(UserEvent.created_at < before)
+        )).first()
+    if through is None:
+        return 0
+
+    deleted = 0
+    while True:
+        async with async_session_maker() as session:
+            # The mark moves first so no client is served a partly pruned range.
+            retention = await session.get(UserEventRetention, 1) or UserEventRetention(id=1)
+            retention.pruned_through_seq = max(retention.pruned_through_seq, through)
+            retention.pruned_at = datetime.now(UTC)
+            session.add(retention)
+
+            batch = select(UserEvent.seq).where(UserEvent.seq <= through).order_by(UserEvent.seq).limit(batch_size)
+            result = await session.execute(delete(UserEvent).where(UserEvent.seq.in_(batch)))
+            await session.commit()
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            return deleted
+        await asyncio.sleep(0)
+
+
+async def run_sync_retention() -> None:
+    while True:
+        try:
+            deleted = await prune_events(datetime.now(UTC) - timedelta(days=SYNC_RETENTION_DAYS))
+            if deleted:
+                logger.info('Pruned %d sync events', deleted)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Sync event pruning failed')
+        await asyncio.sleep(SYNC_PRUNE_INTERVAL_S)
+
+
+async def get_sync_page(
+    session: AsyncSession,
+    user_id: uuid.UUID,
+    since: int | None = None,
+    limit: int | None = None,
+) -> SyncPage:
+    # Without a cursor only the current head is returned, so a fresh client
+    # can start tracking from now instead of replaying everything.
+    if since is None:
+        return SyncPage(events=[], next_since=await get_head(session, user_id))
+
+    retention = await session.get(UserEventRetention, 1)
+    if retention is not None and since < retention.pruned_through_seq:
+        return SyncPage(
+            events=[],
+            next_since=max(await get_head(session, user_id), retention.pruned_through_seq),
+            reset_required=True,
+        )
+
+    limit = min(limit or SYNC_MAX_PAGE_SIZE, SYNC_MAX_PAGE_SIZE)
+    rows = (await session.exec(
+        select(UserEvent, Message)
+        .outerjoin(Message, Message.id == UserEvent.message_id)
+        .where(UserEvent.user_id == user_id, UserEvent.seq > since)
+        .order_by(UserEvent.seq)
+        .limit(limit + 1)
+    )).all()
+
+    events = []
+    for event, message in rows[:limit]:
+        out = None
+        if message is not None:
+            out = MessageOut.model_validate(message)
+            if message.deleted:
+                out.body = ''
+        events.append(SyncEvent(
+            seq=event.seq,
+            type=event.type,
+            conversation_id=event.conversation_id,
+            actor_id=event.actor_id,
+            created_at=event.created_at,
+            message=out,
+        ))
+
+    return SyncPage(
+        events=events,
+        next_since=events[-1].seq if events else since,
+        has_more=len(rows) > limit,
+    )
@@ -1,4 +1,9 @@
+import asyncio
+import hashlib
+import threading
+import time
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime, timedelta, UTC
 from typing import Annotated
 
@@ -6,7 +11,16 @@ import jwt
 from fastapi import Depends, Query, HTTPException, WebSocketException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
-from config import TOKEN_SECRET_KEY, TOKEN_ALGORITHM, TOKEN_EXPIRE_MINS, pwd_ctx
+from config import (
+    PASSWORD_HASH_QUEUE,
+    PASSWORD_HASH_WORKERS,
+    TOKEN_ALGORITHM,
+    TOKEN_CACHE_SIZE,
+    TOKEN_EXPIRE_MINS,
+    TOKEN_SECRET_KEY,
+    pwd_ctx,
+)
+from utils.cache import LRUCache
 
 
 def get_password_hash(plain: str) -> str:
@@ -17,6 +31,70 @@ def verify_password(plain: str, hashed: str) -> bool:
     return pwd_ctx.verify(plain, hashed)
 
 
+class PasswordHasherBusy(Exception):
+    pass
+
+
+# bcrypt releases the GIL, so a few threads keep hashing off the event loop.
+# At most workers + queue calls are admitted; the rest are rejected rather
+# than left to queue up behind a login burst.
+_hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix='password-hash')
+_hash_stats = {'in_flight': 0, 'running': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+_stats_lock = threading.Lock()
+
+
+def _hash_job_done(job: Future) -> None:
+    # Runs when the job itself finishes (or is cancelled before it started),
+    # not when its caller stops waiting: a cancelled request's hash keeps a
+    # worker busy, so it keeps counting against admission until then.
+    with _stats_lock:
+        _hash_stats['in_flight'] -= 1
+        if job.cancelled():
+            return
+        if job.exception() is not None:
+            _hash_stats['failed'] += 1
+        else:
+            _hash_stats['completed'] += 1
+
+
+async def _run_hashing(fn, *args):
+    def run():
+        with _stats_lock:
+            _hash_stats['running'] += 1
+        try:
+            return fn(*args)
+        finally:
+            with _stats_lock:
+                _hash_stats['running'] -= 1
+
+    with _stats_lock:
+        if _hash_stats['in_flight'] >= PASSWORD_HASH_WORKERS + PASSWORD_HASH_QUEUE:
+            _hash_stats['rejected'] += 1
+            raise PasswordHasherBusy()
+        _hash_stats['in_flight'] += 1
+
+    job = _hash_pool.submit(run)
+    job.add_done_callback(_hash_job_done)
+    return await asyncio.wrap_future(job)
+
+
+async def get_password_hash_async(plain: str) -> str:
+    return await _run_hashing(get_password_hash, plain)
+
+
+async def verify_password_async(plain: str, hashed: str) -> bool:
+    return await _run_hashing(verify_password, plain, hashed)
+
+
+def password_hash_pool_stats() -> dict:
+    return {
+        'workers': PASSWORD_HASH_WORKERS,
+        'max_queued': PASSWORD_HASH_QUEUE,
+        'queued': _hash_stats['in_flight'] - _hash_stats['running'],
+        **_hash_stats,
+    }
+
+
 def create_access_token(data: dict) -> str:
     to_encode = data.copy()
     expire = datetime.now(tz=UTC) + timedelta(minutes=TOKEN_EXPIRE_MINS)
@@ -30,31 +108,56 @@ def verify_password(plain: str, hashed: str) -> bool:
 
 def verify_token(token: str) -> bool:
     try:
-        decoded_data = jwt.decode(token, TOKEN_SECRET_KEY, algorithms=[TOKEN_ALGORITHM])
+        decode_token(token)
     except jwt.InvalidTokenError:
         return False
-
-    if datetime.fromtimestamp(decoded_data['exp'], tz=UTC) <= datetime.now(tz=UTC):
-        return False
-    
     return True
 
 
 def decode_token(token: str) -> dict:
-    return jwt.decode(token, TOKEN_SECRET_KEY, algorithms=[TOKEN_ALGORITHM])
+    # PyJWT checks the signature and exp in the same pass.
+    return jwt.decode(
+        token,
+        TOKEN_SECRET_KEY,
+        algorithms=[TOKEN_ALGORITHM],
+        options={'require': ['exp', 'sub']},
+    )
+
+
+# sha256(token) -> user id, each entry expiring at the token's own exp.
+# LRUCache is not thread-safe: only touch it from the event loop, which is
+# why the dependencies below are async.
+_verified_tokens = LRUCache(TOKEN_CACHE_SIZE)
 
 
 def get_token_user_id(token: str) -> uuid.UUID | None:
-    if token is None or not verify_token(token):
+    if token is None:
         return None
 
-    token_data = decode_token(token)
-    return uuid.UUID(token_data['sub'])
+    digest = hashlib.sha256(token.encode()).digest()
+    user_id = _verified_tokens.get(digest)
+    if user_id is not None:
+        return user_id
+
+    try:
+        token_data = decode_token(token)
+        user_id = uuid.UUID(token_data['sub'])
+    except (jwt.InvalidTokenError, ValueError, TypeError):
+        return None
+
+    ttl_s = token_data['exp'] - time.time()
+    if ttl_s > 0:
+        _verified_tokens.set(digest, user_id, ttl_s=ttl_s)
+    return user_id
+
+
+def token_cache_stats() -> dict:
+    return _verified_tokens.stats()
 
 
 security = HTTPBearer()
 
-def get_token_user_id_http(
+async def get_token_user_id_http(
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)]
 ):
     token = credentials.credentials
@@ -68,7 +171,7 @@ def get_token_user_id_http(
     return res
 
 
-def get_token_user_id_ws(token: Annotated[str, Query()] = None):
+async def get_token_user_id_ws(token: Annotated[str, Query()] = None):
     res = get_token_user_id(token)
     if res is None:
         raise WebSocketException(status.WS_1008_POLICY_VIOLATION, 'Invalid token')
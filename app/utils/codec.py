@@ -0,0 +1,117 @@
+import json
+import uuid
+from datetime import date, datetime
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f'Cannot encode {type(obj).__name__}')
+
+
+class Codec:
+    name: str
+    content_type: str
+    # WebSocket frames are text for JSON codecs and binary otherwise.
+    binary: bool = False
+
+    def dumps(self, obj: Any) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data: bytes | str) -> Any:
+        raise NotImplementedError
+
+    def encode_frame(self, obj: Any) -> str | bytes:
+        data = self.dumps(obj)
+        return data if self.binary else data.decode()
+
+    def frame_from_bytes(self, data: bytes) -> str | bytes:
+        # An already-encoded body (e.g. from the broker) as a WebSocket frame.
+        return data if self.binary else data.decode()
+
+
+class JsonCodec(Codec):
+    name = 'json'
+    content_type = 'application/json'
+
+    def dumps(self, obj: Any) -> bytes:
+        return self.encode_frame(obj).encode()
+
+    def encode_frame(self, obj: Any) -> str:
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False, default=_default)
+
+    def loads(self, data: bytes | str) -> Any:
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            raise DecodeError(str(e)) from e
+
+
+# Same wire format as JsonCodec, so clients of either share encoded frames.
+class OrjsonCodec(Codec):
+    name = 'orjson'
+    content_type = 'application/json'
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj, default=_default)
+
+    def loads(self, data: bytes | str) -> Any:
+        try:
+            return orjson.loads(data)
+        except ValueError as e:
+            raise DecodeError(str(e)) from e
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+    content_type = 'application/msgpack'
+    binary = True
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj, default=_default)
+
+    def loads(self, data: bytes | str) -> Any:
+        if isinstance(data, str):
+            raise DecodeError('Expected a binary frame')
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except (ValueError, TypeError) as e:
+            raise DecodeError(str(e)) from e
+
+
+JSON = JsonCodec()
+
+CODECS: dict[str, Codec] = {'json': JSON}
+if orjson is not None:
+    CODECS['orjson'] = OrjsonCodec()
+if msgpack is not None:
+    CODECS['msgpack'] = MsgpackCodec()
+
+# Later entries win, so JSON bodies are decoded with orjson when it is installed.
+_BY_CONTENT_TYPE = {codec.content_type: codec for codec in CODECS.values()}
+
+
+def get_codec(name: str) -> Codec | None:
+    return CODECS.get(name)
+
+
+def codec_for_content_type(content_type: str | None) -> Codec | None:
+    # Bodies published before content types were set are JSON.
+    return _BY_CONTENT_TYPE.get(content_type or JSON.content_type)
@@ -1,19 +1,50 @@
+import hashlib
+
 from cryptography.fernet import Fernet, InvalidToken
-from config import DATA_ENCRYPTION_KEYS
+from config import DATA_ENCRYPTION_KEYS, DECRYPT_CACHE_SIZE, DECRYPT_CACHE_TTL_S
+from utils.cache import LRUCache
 
 _PREFIX = 'enc:'
+# enc:v2:<key id>:<token>; plain enc:<token> is the legacy untagged format.
+_V2_PREFIX = 'enc:v2:'
+
+def _key_id(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()[:8]
 
+_primary_kid = _key_id(DATA_ENCRYPTION_KEYS[0])
 _primary = Fernet(DATA_ENCRYPTION_KEYS[0].encode())
 _all = [Fernet(k.encode()) for k in DATA_ENCRYPTION_KEYS]
+_by_kid = {_key_id(k): f for k, f in zip(DATA_ENCRYPTION_KEYS, _all)}
+
+# Opt-in: keeps plaintexts in memory, keyed by a digest of the ciphertext.
+_decrypted = LRUCache(DECRYPT_CACHE_SIZE, DECRYPT_CACHE_TTL_S)
 
 def encrypt_str(value: str) -> str:
     token = _primary.encrypt(value.encode('utf-8')).decode('utf-8')
-    return _PREFIX + token
+    return f'{_V2_PREFIX}{_primary_kid}:{token}'
 
 def decrypt_str(value: str) -> str:
     if not value.startswith(_PREFIX):
         return value
 
+    if not _decrypted.maxsize:
+        return _decrypt(value)
+
+    digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+    plaintext = _decrypted.get(digest)
+    if plaintext is None:
+        plaintext = _decrypt(value)
+        _decrypted.set(digest, plaintext)
+    return plaintext
+
+def _decrypt(value: str) -> str:
+    if value.startswith(_V2_PREFIX):
+        kid, _, token = value[len(_V2_PREFIX):].partition(':')
+        f = _by_kid.get(kid)
+        if f is None:
+            raise ValueError(f'Unable to decrypt (unknown key id {kid})')
+        return f.decrypt(token.encode('utf-8')).decode('utf-8')
+
     token = value[len(_PREFIX):].encode('utf-8')
     for f in _all:
         try:
@@ -21,3 +52,21 @@ def decrypt_str(value: str) -> str:
         except InvalidToken:
             pass
     raise ValueError('Unable to decrypt (no key matched)')
+
+def primary_key_id() -> str:
+    return _primary_kid
+
+def is_current(value: str) -> bool:
+    return value.startswith(f'{_V2_PREFIX}{_primary_kid}:')
+
+def reencrypt_str(value: str) -> str:
+    # Bypasses the decrypt cache so rotation does not fill it with cold rows.
+    if not value.startswith(_PREFIX):
+        return encrypt_str(value)
+    return encrypt_str(_decrypt(value))
+
+def purge_decrypt_cache() -> None:
+    _decrypted.clear()
+
+def decrypt_cache_stats() -> dict:
+    return _decrypted.stats()
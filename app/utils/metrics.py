@@ -0,0 +1,207 @@
+import logging
+import math
+import time
+from bisect import bisect_left
+from typing import Callable
+
+# Seconds, from sub-millisecond cache hits to multi-second stalls.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_str(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type: str
+    suffix = ''
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], object] = {}
+        if not labelnames:
+            # Unlabelled series are exported as zero before the first sample.
+            self.labels()
+
+    def labels(self, *values: str):
+        # Children are created once per label set; later calls are a dict hit.
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def _default(self):
+        return self.labels()
+
+    def render(self) -> list[str]:
+        name = self.name + self.suffix
+        lines = [f'# HELP {name} {self.help}', f'# TYPE {name} {self.type}']
+        for values, child in self._children.items():
+            lines += self._render_child(values, child)
+        return lines
+
+    def _render_child(self, values, child) -> list[str]:
+        raise NotImplementedError
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    type = 'counter'
+    # The text format names counter samples and metadata alike with _total.
+    suffix = '_total'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1) -> None:
+        self._default().inc(amount)
+
+    def _render_child(self, values, child) -> list[str]:
+        return [f'{self.name}_total{_label_str(self.labelnames, values)} {_format(child.value)}']
+
+
+class _Timer:
+    __slots__ = ('child', 'started')
+
+    def __init__(self, child: '_HistogramChild'):
+        self.child = child
+
+    def __enter__(self) -> None:
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        self.child.observe(time.perf_counter() - self.started)
+
+
+class _HistogramChild:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: tuple[float, ...]):
+        self.bounds = bounds
+        # Per-bucket, not cumulative, so observe() touches one slot.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def time(self) -> _Timer:
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, values, child) -> list[str]:
+        lines, total = [], 0
+        for bound, count in zip((*self.buckets, math.inf), child.counts):
+            total += count
+            le = _label_str(self.labelnames, values, f'le="{_format(bound)}"')
+            lines.append(f'{self.name}_bucket{le} {total}')
+        labels = _label_str(self.labelnames, values)
+        lines.append(f'{self.name}_sum{labels} {_format(child.sum)}')
+        lines.append(f'{self.name}_count{labels} {total}')
+        return lines
+
+
+# Read at scrape time, so nothing is recorded on the hot path.
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, read: Callable[[], float]):
+        self.read = read
+        super().__init__(name, help)
+
+    def _new_child(self):
+        return None
+
+    def _render_child(self, values, child) -> list[str]:
+        return [f'{self.name} {_format(self.read())}']
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f'Duplicate metric: {metric.name}')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple[str, ...] = (), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name: str, help: str, read: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, help, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines += metric.render()
+            except Exception:
+                # A broken gauge callback should not take the whole scrape down.
+                logger.exception('Failed to render metric %s', metric.name)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+WS_HANDLER_SECONDS = registry.histogram(
+    'ws_handler_seconds', 'WebSocket write event handling, including the commit.', ('type',),
+)
+DB_COMMIT_SECONDS = registry.histogram('db_commit_seconds', 'Session commit time.', ('path',))
+RMQ_PUBLISH_SECONDS = registry.histogram('rmq_publish_seconds', 'Broker publish time, confirms included.', ('method',))
+BRIDGE_HANDLE_SECONDS = registry.histogram('bridge_handle_seconds', 'Time to bridge one broker message to sockets.')
+FANOUT_SOCKETS = registry.histogram(
+    'bridge_fanout_sockets', 'Sockets each bridged broker message was queued to.', buckets=SIZE_BUCKETS,
+)
+WS_ERRORS = registry.counter('ws_errors', 'Error frames sent to WebSocket clients.', ('code',))
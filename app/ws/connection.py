@@ -1,24 +1,247 @@
+import asyncio
+import logging
+import time
 import uuid
+from collections import deque
+from enum import StrEnum
 
 from fastapi import WebSocket
+from starlette.websockets import WebSocketState
+
+from config import (
+    RMQ_PRESENCE_BIND_TIMEOUT_S,
+    WS_IDLE_TICK_S,
+    WS_IDLE_TIMEOUT_S,
+    WS_SEND_QUEUE_SIZE,
+    WS_SLOW_CONSUMER_POLICY,
+)
+from schemas.ws import MESSAGE_SEEN
+from utils.codec import JSON, Codec
+from .idle_timer import IdleTimerWheel
+
+logger = logging.getLogger(__name__)
+
+
+class SlowConsumerPolicy(StrEnum):
+    DROP = 'drop'              # discard the new frame
+    COALESCE = 'coalesce'      # replace a queued frame with the same key, else evict the oldest
+                               # coalescible one; disconnect if nothing queued can be given up
+    DISCONNECT = 'disconnect'  # close the socket; the client reconnects and resyncs
+
+
+def coalesce_key(message: dict) -> tuple | None:
+    # Only frames where the latest one supersedes the earlier ones.
+    if message.get('type') != MESSAGE_SEEN:
+        return None
+    payload = message.get('payload') or {}
+    return (MESSAGE_SEEN, payload.get('conversation_id'), payload.get('user_id'))
+
+
+class Connection:
+    def __init__(
+        self,
+        user_id: uuid.UUID,
+        websocket: WebSocket,
+        max_queue: int = WS_SEND_QUEUE_SIZE,
+        policy: SlowConsumerPolicy = SlowConsumerPolicy(WS_SLOW_CONSUMER_POLICY),
+        codec: Codec = JSON,
+    ):
+        self.id = uuid.uuid4()
+        self.user_id = user_id
+        self.websocket = websocket
+        self.codec = codec
+        self.max_queue = max_queue
+        self.policy = policy
+        self.closed = False
+        self.dropped = 0
+        # Owned by the manager's IdleTimerWheel.
+        self.last_seen = time.monotonic()
+        self.timer_slot: int | None = None
+
+        # Slots are [frame, coalesce_key] lists so a coalesced frame can be
+        # swapped in place without walking the queue.
+        self._queue: deque[list] = deque()
+        self._slots: dict[tuple, list] = {}
+        self._wakeup = asyncio.Event()
+        self._writer_task: asyncio.Task | None = None
+        self._close_task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def send(self, message: dict) -> bool:
+        return self.send_frame(self.codec.encode_frame(message), coalesce_key(message))
+
+    def send_frame(self, frame: str | bytes, key: tuple | None = None) -> bool:
+        if self.closed:
+            return False
+
+        if self.policy != SlowConsumerPolicy.COALESCE:
+            key = None
+        if key is not None and key in self._slots:
+            self._slots[key][0] = frame
+            return True
+
+        if len(self._queue) >= self.max_queue:
+            if self.policy == SlowConsumerPolicy.DROP:
+                self.dropped += 1
+                return False
+            # Anything else in the queue is a change the client cannot
+            # recover without resyncing, so it is never evicted.
+            evicted = next(iter(self._slots.values()), None) if self.policy == SlowConsumerPolicy.COALESCE else None
+            if evicted is None:
+                logger.warning('Disconnecting slow consumer user=%s', self.user_id)
+                self.close(1013, 'Too slow')
+                return False
+            self.dropped += 1
+            self._queue.remove(evicted)
+            self._forget(evicted)
+
+        slot = [frame, key]
+        self._queue.append(slot)
+        if key is not None:
+            self._slots[key] = slot
+        self._wakeup.set()
+        return True
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+    async def send_json(self, message: dict) -> None:
+        self.send(message)
+
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def stop(self) -> None:
+        self.closed = True
+        self._queue.clear()
+        self._slots.clear()
+        if self._writer_task is not None and self._writer_task is not asyncio.current_task():
+            self._writer_task.cancel()
+
+    def close(self, code: int = 1000, reason: str = '') -> None:
+        if self.closed:
+            return
+        self.stop()
+        # Held so the task is not garbage-collected before it runs.
+        self._close_task = asyncio.create_task(self._close_socket(code, reason))
+
+    def _forget(self, slot: list) -> None:
+        key = slot[1]
+        if key is not None and self._slots.get(key) is slot:
+            del self._slots[key]
+
+    async def _writer(self) -> None:
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+
+                slot = self._queue.popleft()
+                self._forget(slot)
+                if isinstance(slot[0], bytes):
+                    await self.websocket.send_bytes(slot[0])
+                else:
+                    await self.websocket.send_text(slot[0])
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            logger.debug('Writer for user=%s stopped', self.user_id, exc_info=True)
+            self.close(1011, 'Send failed')
+
+    async def _close_socket(self, code: int, reason: str) -> None:
+        try:
+            if self.websocket.client_state == WebSocketState.CONNECTED:
+                await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: dict[uuid.UUID, WebSocket] = {}
-    
-    async def connect(self, user_id: uuid.UUID, websocket: WebSocket):
+        self.active_connections: dict[uuid.UUID, set[Connection]] = {}
+        self.idle_timer = IdleTimerWheel(
+            WS_IDLE_TIMEOUT_S,
+            WS_IDLE_TICK_S,
+            on_expire=lambda connection: connection.close(1001, 'Heartbeat timeout'),
+        )
+        # Optional services.presence_routing.PresenceRouter, set at startup.
+        self.presence = None
+
+    async def connect(self, user_id: uuid.UUID, websocket: WebSocket, codec: Codec = JSON) -> Connection:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-    
-    def disconnect(self, user_id: uuid.UUID):
-        self.active_connections.pop(user_id, None)
-    
+        if self.presence is not None:
+            # Bound before the socket is registered, with no await in between,
+            # so from then on every event for the user reaches it. Anything
+            # published earlier is for the client's sync, which is only read
+            # once connect() has returned. A bind that outlasts the timeout
+            # finishes in the background rather than holding the socket.
+            try:
+                await asyncio.wait_for(self.presence.user_online(user_id), RMQ_PRESENCE_BIND_TIMEOUT_S)
+            except asyncio.CancelledError:
+                await self.presence.user_offline(user_id)
+                raise
+            except asyncio.TimeoutError:
+                logger.warning('Binding conversations for user=%s is slow, registering the socket anyway', user_id)
+            except Exception:
+                logger.exception('Failed to bind conversations for user=%s', user_id)
+
+        connection = Connection(user_id, websocket, codec=codec)
+        connection.start()
+        self.idle_timer.add(connection)
+        self.active_connections.setdefault(user_id, set()).add(connection)
+        return connection
+
+    async def disconnect(self, connection: Connection):
+        connection.stop()
+        self.idle_timer.remove(connection)
+        connections = self.active_connections.get(connection.user_id)
+        if connections is None or connection not in connections:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self.active_connections[connection.user_id]
+
+        if self.presence is not None:
+            try:
+                await self.presence.user_offline(connection.user_id)
+            except Exception:
+                logger.exception('Failed to unbind conversations for user=%s', connection.user_id)
+
     async def broadcast(self, message: dict):
-        for connection in self.active_connections.values():
-            await connection.send_json(message)
-    
+        self.fan_out(message, list(self.active_connections), key=coalesce_key(message))
+
     async def send_to_user(self, message: dict, user_id: uuid.UUID):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_json(message)
+        self.fan_out(message, (user_id,), key=coalesce_key(message))
+
+    def fan_out(
+        self,
+        message: dict,
+        user_ids,
+        key: tuple | None = None,
+        exclude_connection: uuid.UUID | None = None,
+        frames: dict[str, str | bytes] | None = None,
+    ) -> int:
+        # Encoded at most once per wire format, keyed by content type, and
+        # shared by every socket using it. Callers may pass frames they
+        # already hold, e.g. the broker body itself.
+        frames = {} if frames is None else frames
+        sent = 0
+        for user_id in user_ids:
+            for connection in self.active_connections.get(user_id, ()):
+                if connection.id == exclude_connection:
+                    continue
+                codec = connection.codec
+                frame = frames.get(codec.content_type)
+                if frame is None:
+                    frame = frames[codec.content_type] = codec.encode_frame(message)
+                sent += connection.send_frame(frame, key)
+        return sent
+
+    def connection_count(self) -> int:
+        return sum(len(connections) for connections in self.active_connections.values())
 
 manager = ConnectionManager()
@@ -0,0 +1,79 @@
+import asyncio
+import logging
+import math
+import time
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+# One timer for every socket's idle deadline. Connections sit in the slot
+# of the tick at which they would time out; receiving a frame only stamps
+# connection.last_seen. When a slot comes due, connections seen since are
+# moved to the slot of their new deadline and the rest expire together.
+# Each socket costs one slot move per timeout period, however chatty it is.
+class IdleTimerWheel:
+    def __init__(self, timeout_s: float, tick_s: float, on_expire: Callable):
+        self.timeout_s = timeout_s
+        self.tick_s = tick_s
+        self.on_expire = on_expire
+        self._slots: list[set] = [set() for _ in range(math.ceil(timeout_s / tick_s) + 1)]
+        self._started = time.monotonic()
+        self._tick = 0
+        self._task: asyncio.Task | None = None
+        self.expired = 0
+
+    def add(self, connection) -> None:
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = asyncio.create_task(self._run())
+        connection.last_seen = time.monotonic()
+        self._schedule(connection, connection.last_seen + self.timeout_s)
+
+    def remove(self, connection) -> None:
+        slot = getattr(connection, 'timer_slot', None)
+        if slot is not None:
+            self._slots[slot].discard(connection)
+            connection.timer_slot = None
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        task, self._task = self._task, None
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self) -> dict:
+        return {'connections': sum(len(slot) for slot in self._slots), 'expired': self.expired}
+
+    def _schedule(self, connection, deadline: float) -> None:
+        tick = max(math.ceil((deadline - self._started) / self.tick_s), self._tick + 1)
+        connection.timer_slot = tick % len(self._slots)
+        self._slots[connection.timer_slot].add(connection)
+
+    async def _run(self) -> None:
+        while True:
+            self._tick += 1
+            await asyncio.sleep(max(0.0, self._started + self._tick * self.tick_s - time.monotonic()))
+
+            index = self._tick % len(self._slots)
+            due, self._slots[index] = self._slots[index], set()
+            now = time.monotonic()
+            expired = []
+            for connection in due:
+                deadline = connection.last_seen + self.timeout_s
+                if deadline <= now:
+                    connection.timer_slot = None
+                    expired.append(connection)
+                else:
+                    self._schedule(connection, deadline)
+
+            self.expired += len(expired)
+            for connection in expired:
+                try:
+                    self.on_expire(connection)
+                except Exception:
+                    logger.exception('Failed to expire idle connection')
@@ -1,53 +1,54 @@
-import asyncio
-import json
 import logging
-import time
 import uuid
-from typing import Annotated
-from sqlmodel import Session
+from typing import Annotated, Any
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, status
+from fastapi import APIRouter, Depends, Query, WebSocket, WebSocketException, status
 from pydantic import ValidationError
-from starlette.concurrency import run_in_threadpool
 from starlette.websockets import WebSocketState
 
 import services.messaging as messaging_service
-from db.session import get_session
+from config import GROUP_COMMIT_ENABLED, WS_BATCH_MAX_OPS
+from services.group_commit import group_commit_writer
+from services.membership_cache import get_username
+from services.outbox import enqueue_event, outbox_relay
+from services.sync import get_sync_page
+from db.session import async_read_session_maker, async_session_maker, pool_stats
 from schemas.ws import (
+    MESSAGE_CREATED,
+    MESSAGE_DELETED,
+    MESSAGE_DELIVERED,
+    MESSAGE_EDITED,
+    MESSAGE_EVENTS,
+    MESSAGE_SEEN,
+    WSBatch,
     WSRequest,
     WSMessageCreate,
     WSMessageEdit,
     WSMessageDelete,
     WSMessageDelivered,
     WSMessageSeen,
+    WSSync,
     handle_ping,
 )
 from utils.auth import get_token_user_id_ws
-from .connection import manager
+from utils.codec import Codec, DecodeError, get_codec
+from utils.metrics import DB_COMMIT_SECONDS, WS_ERRORS, WS_HANDLER_SECONDS
+from .connection import Connection, manager
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix='/ws')
 
+_commit_seconds = DB_COMMIT_SECONDS.labels('own_session')
+
 EVENT_HANDLERS = {
-    'message.create': (WSMessageCreate, messaging_service.create_message, 'conversation.{conversation_id}.created'),
-    'message.edit': (WSMessageEdit, messaging_service.edit_message, 'conversation.{conversation_id}.edited'),
-    'message.delete': (WSMessageDelete, messaging_service.delete_message, 'conversation.{conversation_id}.deleted'),
-    'message.seen': (WSMessageSeen, messaging_service.mark_seen, 'conversation.{conversation_id}.seen'),
-    'message.delivered': (WSMessageDelivered, messaging_service.mark_delivered, 'conversation.{conversation_id}.delivered'),
+    MESSAGE_CREATED: (WSMessageCreate, messaging_service.create_message, 'conversation.{conversation_id}.created'),
+    MESSAGE_EDITED: (WSMessageEdit, messaging_service.edit_message, 'conversation.{conversation_id}.edited'),
+    MESSAGE_DELETED: (WSMessageDelete, messaging_service.delete_message, 'conversation.{conversation_id}.deleted'),
+    MESSAGE_SEEN: (WSMessageSeen, messaging_service.mark_seen, 'conversation.{conversation_id}.seen'),
+    MESSAGE_DELIVERED: (WSMessageDelivered, messaging_service.mark_delivered, 'conversation.{conversation_id}.delivered'),
 }
 
-PING_IDLE_TIMEOUT_S = 75
-WATCHDOG_TICK_S = 5
-
-
-async def heartbeat_watchdog(websocket: WebSocket, last_seen: dict) -> None:
-    while True:
-        await asyncio.sleep(WATCHDOG_TICK_S)
-        if time.time() - last_seen['t'] > PING_IDLE_TIMEOUT_S:
-            await safe_close(websocket, 1001, 'Heartbeat timeout')
-            return
-
-
 async def safe_close(ws: WebSocket, code: int, reason: str = ''):
     try:
         if ws.client_state == WebSocketState.CONNECTED:
@@ -56,9 +57,10 @@ async def safe_close(ws: WebSocket, code: int, reason: str = ''):
         pass
 
 
-async def ws_send_error(websocket: WebSocket, code: str, message: str, details: dict | None = None):
+async def ws_send_error(connection: Connection, code: str, message: str, details: dict | None = None):
+    WS_ERRORS.labels(code).inc()
     try:
-        await websocket.send_json(
+        await connection.send_json(
             {
                 'type': 'error',
                 'payload': {
@@ -87,48 +89,207 @@ def build_routing_key(template: str, payload: dict, result: dict) -> str | None:
     return template.format(**ctx)
 
 
-def call_handler_in_own_session(handler, user_id: uuid.UUID, payload: dict) -> dict:
-    gen = get_session()
-    session = next(gen)
+def with_outbox(handler, event_type: str, routing_key_template: str, username: str, connection_id: uuid.UUID):
+    # Writes the broker event to the outbox inside the handler's transaction,
+    # so it is published if and only if the change commits.
+    async def handle(session, user_id: uuid.UUID, payload: dict) -> dict:
+        result = await handler(session, user_id, payload)
+        if event_type in MESSAGE_EVENTS:
+            result['sender_username'] = username
+        rk = build_routing_key(routing_key_template, payload, result)
+        if rk is None:
+            logger.warning('No conversation_id for routing event=%s', event_type)
+        else:
+            enqueue_event(session, rk, {'type': event_type, 'payload': result}, connection_id)
+        return result
+
+    return handle
+
+
+class BatchOpError(Exception):
+    def __init__(self, index: int, error: Exception):
+        super().__init__(str(error))
+        self.index = index
+        self.error = error
+
+
+def batch_with_outbox(ops: list[tuple[str, Any, str, dict]], username: str, connection_id: uuid.UUID):
+    # Runs every operation in the caller's transaction; the first failure
+    # rolls the whole batch back. Broker events are merged into one 'batch'
+    # event per conversation, in the order the operations ran.
+    async def handle(session, user_id: uuid.UUID, payload: dict) -> dict:
+        results = []
+        by_conversation: dict[str, list[dict]] = {}
+        for index, (event_type, handler, routing_key_template, op_payload) in enumerate(ops):
+            try:
+                result = await handler(session, user_id, op_payload)
+            except Exception as e:
+                raise BatchOpError(index, e) from e
+            if event_type in MESSAGE_EVENTS:
+                result['sender_username'] = username
+            event = {'type': event_type, 'payload': result}
+            results.append(event)
+
+            conversation_id = build_routing_key('{conversation_id}', op_payload, result)
+            if conversation_id is None:
+                logger.warning('No conversation_id for routing event=%s', event_type)
+            else:
+                by_conversation.setdefault(conversation_id, []).append(event)
+
+        for conversation_id, events in by_conversation.items():
+            enqueue_event(session, f'conversation.{conversation_id}.batch', {
+                'type': 'batch',
+                'payload': {
+                    'conversation_id': conversation_id,
+                    'user_id': str(user_id),
+                    'events': events,
+                },
+            }, connection_id)
+        return {'results': results}
+
+    return handle
+
+
+def handler_error(exc: Exception) -> tuple[str, str]:
+    if isinstance(exc, messaging_service.PermissionError):
+        return 'forbidden', str(exc)
+    if isinstance(exc, (messaging_service.BadRequestError, ValidationError)):
+        return 'bad_request', str(exc)
+    if isinstance(exc, messaging_service.NotFoundError):
+        return 'not_found', str(exc)
+    if isinstance(exc, PoolTimeoutError):
+        logger.warning('db pool exhausted: %r', pool_stats())
+        return 'server_busy', 'Server is busy, retry later'
+    logger.error('handler crash', exc_info=exc)
+    return 'server_error', 'Internal error in handler'
+
+
+async def call_handler_in_own_session(handler, user_id: uuid.UUID, payload: dict) -> dict:
+    async with async_session_maker() as session:
+        result = await handler(session, user_id, payload)
+        with _commit_seconds.time():
+            await session.commit()
+        return result
+
+
+async def call_handler(handler, user_id: uuid.UUID, payload: dict) -> dict:
+    if GROUP_COMMIT_ENABLED:
+        return await group_commit_writer.submit(handler, user_id, payload)
+    return await call_handler_in_own_session(handler, user_id, payload)
+
+
+async def handle_sync(connection: Connection, user_id: uuid.UUID, payload: dict) -> None:
     try:
-        return handler(session, user_id, payload)
-    finally:
-        gen.close()
+        request = WSSync.model_validate(payload)
+    except ValidationError as e:
+        await ws_send_error(connection, 'bad_request', 'Invalid payload', {'err': str(e)})
+        return
+
+    try:
+        with WS_HANDLER_SECONDS.labels('sync').time():
+            async with async_read_session_maker() as session:
+                page = await get_sync_page(session, user_id, since=request.since, limit=request.limit)
+    except PoolTimeoutError:
+        logger.warning('db pool exhausted: %r', pool_stats())
+        await ws_send_error(connection, 'server_busy', 'Server is busy, retry later')
+        return
+
+    connection.send({'type': 'sync', 'payload': page.model_dump(mode='json')})
+
+
+async def handle_batch(connection: Connection, user_id: uuid.UUID, username: str, payload: dict) -> bool:
+    try:
+        batch = WSBatch.model_validate(payload)
+    except ValidationError as e:
+        await ws_send_error(connection, 'bad_request', 'Invalid payload', {'err': str(e)})
+        return True
+
+    if len(batch.ops) > WS_BATCH_MAX_OPS:
+        await ws_send_error(connection, 'bad_request', f'At most {WS_BATCH_MAX_OPS} operations per batch')
+        return True
+
+    # Validate everything before touching the database.
+    ops = []
+    for index, op in enumerate(batch.ops):
+        if op.type not in EVENT_HANDLERS:
+            await ws_send_error(connection, 'bad_request', f'Unknown type: {op.type}', {'index': index})
+            return True
+        payload_schema, handler, routing_key_template = EVENT_HANDLERS[op.type]
+        try:
+            op_payload = payload_schema.model_validate(op.payload).model_dump()
+        except ValidationError as e:
+            await ws_send_error(connection, 'bad_request', 'Invalid payload', {'index': index, 'err': str(e)})
+            return True
+        ops.append((op.type, handler, routing_key_template, op_payload))
+
+    try:
+        with WS_HANDLER_SECONDS.labels('batch').time():
+            result = await call_handler(batch_with_outbox(ops, username, connection.id), user_id, {})
+    except BatchOpError as e:
+        code, message = handler_error(e.error)
+        await ws_send_error(connection, code, message, {'index': e.index})
+        return True
+    except Exception as e:
+        await ws_send_error(connection, *handler_error(e))
+        return True
+
+    outbox_relay.notify()
+    # A False from send() only means the frame was not queued; stop reading
+    # only once the slow-consumer policy has actually closed the socket.
+    connection.send({'type': 'batch', 'payload': result})
+    return not connection.closed
+
+
+def get_ws_codec(codec: Annotated[str, Query()] = 'json') -> Codec:
+    res = get_codec(codec)
+    if res is None:
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION, f'Unsupported codec: {codec}')
+    return res
 
 
 @router.websocket('')
 async def ws_messages_endpoint(
     websocket: WebSocket,
     user_id: Annotated[uuid.UUID, Depends(get_token_user_id_ws)],
-    session: Session = Depends(get_session),
+    codec: Annotated[Codec, Depends(get_ws_codec)],
 ):
-    await manager.connect(user_id, websocket)
-
-    last_seen = {'t': time.time()}
-    watchdog_task = asyncio.create_task(heartbeat_watchdog(websocket, last_seen))
+    # Stamped on published message events so the bridge can forward the
+    # broker body to recipients without re-encoding it. Resolved before the
+    # socket is registered, so a failed lookup leaves nothing to clean up.
+    username = await get_username(user_id)
+    connection = await manager.connect(user_id, websocket, codec=codec)
 
     try:
         while True:
-            try:
-                data_text = await websocket.receive_text()
-            except WebSocketDisconnect:
+            frame = await websocket.receive()
+            if frame['type'] == 'websocket.disconnect':
                 break
 
-            last_seen['t'] = time.time()
+            connection.touch()
 
             try:
-                raw = json.loads(data_text)
+                data = frame.get('text')
+                raw = codec.loads(data if data is not None else frame.get('bytes'))
                 ws_request = WSRequest.model_validate(raw)
-            except (json.JSONDecodeError, ValidationError) as e:
-                await ws_send_error(websocket, 'bad_request', 'Invalid JSON/schema', {'err': str(e)})
+            except (DecodeError, ValidationError) as e:
+                await ws_send_error(connection, 'bad_request', f'Invalid {codec.name}/schema', {'err': str(e)})
                 continue
 
             if ws_request.type == 'ping':
-                await handle_ping(websocket, ws_request.payload or {})
+                await handle_ping(connection, ws_request.payload or {})
+                continue
+
+            if ws_request.type == 'sync':
+                await handle_sync(connection, user_id, ws_request.payload or {})
+                continue
+
+            if ws_request.type == 'batch':
+                if not await handle_batch(connection, user_id, username, ws_request.payload or {}):
+                    break
                 continue
 
             if ws_request.type not in EVENT_HANDLERS:
-                await ws_send_error(websocket, 'bad_request', f'Unknown type: {ws_request.type}')
+                await ws_send_error(connection, 'bad_request', f'Unknown type: {ws_request.type}')
                 continue
 
             payload_schema, handler, routing_key_template = EVENT_HANDLERS[ws_request.type]
@@ -136,54 +297,29 @@ async def ws_messages_endpoint(
             try:
                 payload = payload_schema.model_validate(ws_request.payload).model_dump()
             except ValidationError as e:
-                await ws_send_error(websocket, 'bad_request', 'Invalid payload', {'err': str(e)})
+                await ws_send_error(connection, 'bad_request', 'Invalid payload', {'err': str(e)})
                 continue
 
             try:
-                result = await run_in_threadpool(handler, session, user_id, payload)
-            except messaging_service.PermissionError as e:
-                await ws_send_error(websocket, 'forbidden', str(e))
-                continue
-            except messaging_service.BadRequestError as e:
-                await ws_send_error(websocket, 'bad_request', str(e))
-                continue
-            except messaging_service.NotFoundError as e:
-                await ws_send_error(websocket, 'not_found', str(e))
-                continue
-            except ValueError as e:
-                await ws_send_error(websocket, 'not_found', str(e))
-                continue
-            except Exception:
-                logger.exception('handler crash')
-                await ws_send_error(websocket, 'server_error', 'Internal error in handler')
+                with WS_HANDLER_SECONDS.labels(ws_request.type).time():
+                    result = await call_handler(
+                        with_outbox(handler, ws_request.type, routing_key_template, username, connection.id),
+                        user_id,
+                        payload,
+                    )
+            except Exception as e:
+                await ws_send_error(connection, *handler_error(e))
                 continue
 
-            event = {'type': ws_request.type, 'payload': result}
+            outbox_relay.notify()
 
-            try:
-                await websocket.send_json(event)
-            except Exception:
+            connection.send({'type': ws_request.type, 'payload': result})
+            if connection.closed:
                 break
 
-            try:
-                rk = build_routing_key(routing_key_template, payload, result)
-                if rk is None:
-                    await ws_send_error(websocket, 'bad_event', 'No conversation_id for routing')
-                    continue
-
-                await websocket.app.state.message_publisher.publish(
-                    routing_key=rk,
-                    payload=event,
-                )
-            except Exception:
-                logger.exception('publish crash')
-                await ws_send_error(websocket, 'broker_error', 'Failed to publish event')
-                continue
-
     except Exception:
         logger.exception('ws endpoint crashed')
         await safe_close(websocket, 1011, 'Server error')
     finally:
-        watchdog_task.cancel()
-        manager.disconnect(user_id)
+        await manager.disconnect(connection)
         await safe_close(websocket, 1000, 'bye')
@@ -0,0 +1,73 @@
+"""Per-request bearer token validation cost.
+
+"double decode" replays the old get_token_user_id (verify_token decoded the
+JWT and re-checked exp, then decode_token decoded it again). "single decode"
+is the current path with the verified-token cache cleared before every call,
+and "cached" is the current path with --clients distinct tokens cycling:
+
+    python devtools/bench_auth.py --requests 50000 --clients 100
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, UTC
+from pathlib import Path
+
+import jwt
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'app'))
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('DATA_ENCRYPTION_KEYS', Fernet.generate_key().decode())
+
+from config import TOKEN_ALGORITHM, TOKEN_SECRET_KEY
+from utils import auth
+
+
+def double_decode(token: str) -> uuid.UUID | None:
+    try:
+        decoded = jwt.decode(token, TOKEN_SECRET_KEY, algorithms=[TOKEN_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+    if datetime.fromtimestamp(decoded['exp'], tz=UTC) <= datetime.now(tz=UTC):
+        return None
+    return uuid.UUID(jwt.decode(token, TOKEN_SECRET_KEY, algorithms=[TOKEN_ALGORITHM])['sub'])
+
+
+def single_decode(token: str) -> uuid.UUID | None:
+    auth._verified_tokens.clear()
+    return auth.get_token_user_id(token)
+
+
+def measure(name: str, fn, tokens: list[str], requests: int) -> float:
+    started = time.perf_counter()
+    for i in range(requests):
+        assert fn(tokens[i % len(tokens)]) is not None
+    per_request = (time.perf_counter() - started) / requests
+    print(f'  {name:<15} {per_request * 1e6:>8.1f} us/request')
+    return per_request
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--clients', type=int, default=100)
+    args = parser.parse_args()
+
+    tokens = [
+        auth.create_access_token({'sub': str(uuid.uuid4()), 'username': f'user{i}'})
+        for i in range(args.clients)
+    ]
+
+    print(f'{args.requests} requests from {args.clients} clients')
+    old = measure('double decode', double_decode, tokens, args.requests)
+    measure('single decode', single_decode, tokens, args.requests)
+    auth._verified_tokens.clear()
+    cached = measure('cached', auth.get_token_user_id, tokens, args.requests)
+    print(f'  cache: {auth.token_cache_stats()}, {old / cached:.1f}x faster than before')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""Encode/decode cost and wire size of each utils.codec codec.
+
+Events are shaped like the ones the WebSocket and broker paths carry: a
+message.create, a message.seen receipt, and a 'batch' of delivered receipts.
+Only codecs whose library is installed are measured:
+
+    python devtools/bench_codec.py --iterations 20000
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, UTC
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'app'))
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('DATA_ENCRYPTION_KEYS', Fernet.generate_key().decode())
+
+from utils.codec import CODECS
+
+
+def message_event() -> dict:
+    now = datetime.now(UTC).isoformat()
+    return {
+        'type': 'message.create',
+        'payload': {
+            'id': str(uuid.uuid4()),
+            'conversation_id': str(uuid.uuid4()),
+            'sender_id': str(uuid.uuid4()),
+            'sender_username': 'alice',
+            'body': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit.',
+            'created_at': now,
+            'edited': False,
+            'deleted': False,
+            'status': 'SENT',
+            'delivered_at': None,
+        },
+    }
+
+
+def seen_event() -> dict:
+    return {
+        'type': 'message.seen',
+        'payload': {
+            'conversation_id': str(uuid.uuid4()),
+            'user_id': str(uuid.uuid4()),
+            'last_seen_message_id': str(uuid.uuid4()),
+            'seen_at': datetime.now(UTC).isoformat(),
+        },
+    }
+
+
+def batch_event(size: int) -> dict:
+    conversation_id, user_id = str(uuid.uuid4()), str(uuid.uuid4())
+    return {
+        'type': 'batch',
+        'payload': {
+            'conversation_id': conversation_id,
+            'user_id': user_id,
+            'events': [
+                {
+                    'type': 'message.delivered',
+                    'payload': {
+                        'conversation_id': conversation_id,
+                        'message_id': str(uuid.uuid4()),
+                        'user_id': user_id,
+                        'delivered_at': datetime.now(UTC).isoformat(),
+                    },
+                }
+                for _ in range(size)
+            ],
+        },
+    }
+
+
+def per_call_us(fn, arg, iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--batch-size', type=int, default=50)
+    args = parser.parse_args()
+
+    events = {
+        'message.create': message_event(),
+        'message.seen': seen_event(),
+        f'batch x{args.batch_size}': batch_event(args.batch_size),
+    }
+    print(f'{"event":>16} {"codec":>8} {"bytes":>7} {"encode us":>10} {"decode us":>10}')
+    for label, event in events.items():
+        iterations = args.iterations if not label.startswith('batch') else max(args.iterations // args.batch_size, 100)
+        for name, codec in CODECS.items():
+            data = codec.dumps(event)
+            assert codec.loads(data) == event
+            encode = per_call_us(codec.dumps, event, iterations)
+            decode = per_call_us(codec.loads, data, iterations)
+            print(f'{label:>16} {name:>8} {len(data):>7} {encode:>10.2f} {decode:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
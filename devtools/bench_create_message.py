@@ -0,0 +1,73 @@
+"""Messages/sec of services.messaging.create_message against group size.
+
+Runs against a throwaway SQLite file, one short-lived session per message
+(the same shape as the WebSocket path):
+
+    python devtools/bench_create_message.py --messages 500 --sizes 2 10 50 100 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'app'))
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('DATA_ENCRYPTION_KEYS', Fernet.generate_key().decode())
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from schemas import Conversation, ConversationParticipant, User
+from services.messaging import create_message
+
+
+async def run(sizes: list[int], messages: int) -> None:
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f'sqlite+aiosqlite:///{tmp}/bench.db')
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+        maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+        async with maker() as session:
+            users = [User(username=f'user{i}', password_hash='x') for i in range(max(sizes))]
+            session.add_all(users)
+            await session.commit()
+
+        print(f'{"group size":>10} {"msgs/sec":>10} {"ms/msg":>8}')
+        for size in sizes:
+            group = Conversation(title=f'group of {size}', is_group=True)
+            async with maker() as session:
+                session.add(group)
+                session.add_all(
+                    ConversationParticipant(conversation_id=group.id, user_id=u.id) for u in users[:size]
+                )
+                await session.commit()
+
+            sender_id = users[0].id
+            started = time.perf_counter()
+            for i in range(messages):
+                async with maker() as session:
+                    await create_message(session, sender_id, {'conversation_id': group.id, 'body': f'message {i}'})
+                    await session.commit()
+            elapsed = time.perf_counter() - started
+            print(f'{size:>10} {messages / elapsed:>10.1f} {elapsed / messages * 1000:>8.2f}')
+
+        await engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2, 10, 50, 100, 200])
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.messages))
+
+
+if __name__ == '__main__':
+    main()
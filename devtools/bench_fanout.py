@@ -0,0 +1,91 @@
+"""Fan-out cost per event: encode per recipient vs encode once.
+
+"per-recipient" calls ConnectionManager.send_to_user for every participant,
+which serializes the event each time (the old bridge behaviour).
+"encode-once" hands the event to fan_out, which serializes it once.
+Sockets are stand-ins, so this measures only serialization and enqueueing:
+
+    python devtools/bench_fanout.py --events 2000 --sizes 10 50 200 1000
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'app'))
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('DATA_ENCRYPTION_KEYS', Fernet.generate_key().decode())
+
+from ws.connection import Connection, ConnectionManager
+
+
+def make_event() -> dict:
+    return {
+        'type': 'message.create',
+        'payload': {
+            'id': str(uuid.uuid4()),
+            'conversation_id': str(uuid.uuid4()),
+            'sender_id': str(uuid.uuid4()),
+            'sender_username': 'alice',
+            'body': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 3,
+            'created_at': '2025-01-01T12:00:00+00:00',
+            'edited': False,
+            'deleted': False,
+            'status': 'DELIVERED',
+            'delivered_at': '2025-01-01T12:00:00+00:00',
+        },
+    }
+
+
+def build_manager(size: int) -> tuple[ConnectionManager, list[uuid.UUID]]:
+    manager = ConnectionManager()
+    user_ids = [uuid.uuid4() for _ in range(size)]
+    for user_id in user_ids:
+        # Writers are never started, so frames just accumulate in the queue.
+        manager.active_connections[user_id] = {Connection(user_id, websocket=None, max_queue=10**9)}
+    return manager, user_ids
+
+
+def drain(manager: ConnectionManager) -> None:
+    for connections in manager.active_connections.values():
+        for connection in connections:
+            connection._queue.clear()
+
+
+async def run(sizes: list[int], events: int) -> None:
+    event = make_event()
+    print(f'{"group size":>10} {"per-recipient us/event":>23} {"encode-once us/event":>21} {"speedup":>8}')
+    for size in sizes:
+        manager, user_ids = build_manager(size)
+
+        started = time.perf_counter()
+        for _ in range(events):
+            for user_id in user_ids:
+                await manager.send_to_user(event, user_id)
+        per_recipient = (time.perf_counter() - started) / events
+        drain(manager)
+
+        started = time.perf_counter()
+        for _ in range(events):
+            manager.fan_out(event, user_ids)
+        encode_once = (time.perf_counter() - started) / events
+        drain(manager)
+
+        print(f'{size:>10} {per_recipient * 1e6:>23.1f} {encode_once * 1e6:>21.1f} {per_recipient / encode_once:>7.1f}x')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 50, 200, 1000])
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.events))
+
+
+if __name__ == '__main__':
+    main()
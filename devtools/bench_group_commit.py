@@ -0,0 +1,127 @@
+"""Messages/sec with one commit per event vs GroupCommitWriter.
+
+Each client sends --messages-per-client messages one after another (as a
+WebSocket connection does); clients run concurrently. Runs against a
+throwaway SQLite file with the same pragmas the app would set:
+
+    python devtools/bench_group_commit.py --clients 1 8 32 128
+    python devtools/bench_group_commit.py --journal wal --synchronous NORMAL
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'app'))
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('DATA_ENCRYPTION_KEYS', Fernet.generate_key().decode())
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlmodel import SQLModel
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from db.session import use_explicit_transactions
+from schemas import Conversation, ConversationParticipant, User
+from services.group_commit import GroupCommitWriter
+from services.messaging import create_message
+
+
+def make_engine(url: str, pragmas: dict, pool_size: int, explicit: bool = False):
+    engine = create_async_engine(url, pool_size=pool_size, max_overflow=0, pool_timeout=60)
+
+    @event.listens_for(engine.sync_engine, 'connect')
+    def _pragmas(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    if explicit:
+        use_explicit_transactions(engine, 'BEGIN IMMEDIATE')
+    return engine
+
+
+async def setup(maker, group_size: int):
+    async with maker() as session:
+        users = [User(username=f'user{i}', password_hash='x') for i in range(group_size)]
+        group = Conversation(title='bench', is_group=True)
+        session.add_all(users)
+        session.add(group)
+        session.add_all(ConversationParticipant(conversation_id=group.id, user_id=u.id) for u in users)
+        await session.commit()
+    return group.id, [u.id for u in users]
+
+
+async def per_event(maker, user_id, conversation_id, count):
+    for i in range(count):
+        async with maker() as session:
+            await create_message(session, user_id, {'conversation_id': conversation_id, 'body': f'message {i}'})
+            await session.commit()
+
+
+async def grouped(writer, user_id, conversation_id, count):
+    for i in range(count):
+        await writer.submit(create_message, user_id, {'conversation_id': conversation_id, 'body': f'message {i}'})
+
+
+async def run(args) -> None:
+    pragmas = {'journal_mode': args.journal, 'synchronous': args.synchronous, 'busy_timeout': 60000}
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f'sqlite+aiosqlite:///{tmp}/bench.db'
+        engine = make_engine(url, pragmas, pool_size=args.pool_size)
+        writer_engine = make_engine(url, pragmas, pool_size=1, explicit=True)
+        async with engine.begin() as conn:
+            await conn.run_sync(SQLModel.metadata.create_all)
+
+        maker = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        writer_maker = async_sessionmaker(writer_engine, class_=AsyncSession, expire_on_commit=False)
+        conversation_id, user_ids = await setup(maker, args.group_size)
+
+        print(f'journal={args.journal} synchronous={args.synchronous} group size={args.group_size}')
+        print(f'{"clients":>8} {"per-event msgs/s":>17} {"group msgs/s":>13} {"avg batch":>10}')
+        for clients in args.clients:
+            senders = [user_ids[i % len(user_ids)] for i in range(clients)]
+            total = clients * args.messages_per_client
+
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                per_event(maker, sender, conversation_id, args.messages_per_client) for sender in senders
+            ))
+            per_event_rate = total / (time.perf_counter() - started)
+
+            writer = GroupCommitWriter(writer_maker, max_batch=args.max_batch, max_delay_ms=args.max_delay_ms)
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                grouped(writer, sender, conversation_id, args.messages_per_client) for sender in senders
+            ))
+            grouped_rate = total / (time.perf_counter() - started)
+            await writer.close()
+
+            print(f'{clients:>8} {per_event_rate:>17.1f} {grouped_rate:>13.1f} {writer.stats()["avg_batch"]:>10}')
+
+        await engine.dispose()
+        await writer_engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 8, 32, 128])
+    parser.add_argument('--messages-per-client', type=int, default=20)
+    parser.add_argument('--group-size', type=int, default=10)
+    parser.add_argument('--pool-size', type=int, default=5)
+    parser.add_argument('--max-batch', type=int, default=64)
+    parser.add_argument('--max-delay-ms', type=float, default=2)
+    parser.add_argument('--journal', default='delete')
+    parser.add_argument('--synchronous', default='FULL')
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
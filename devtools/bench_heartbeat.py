@@ -0,0 +1,110 @@
+"""Event-loop overhead of idle-socket heartbeat tracking.
+
+"per-socket" runs the old watchdog: one task per connection that wakes every
+tick and checks its own last-seen time. "wheel" registers the same
+connections with ws.idle_timer.IdleTimerWheel. The sockets are idle stand-ins
+that are never touched, so with --timeout below --duration they all expire
+and that batch is part of the measurement. For each count, the script reports:
+- the CPU used per wall-clock second;
+- how late a 10 ms probe timer fires (p50 and p99), which shows how much
+  the bookkeeping delays everything else on the loop.
+
+    python devtools/bench_heartbeat.py --connections 1000 10000 50000 --duration 10
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from cryptography.fernet import Fernet
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'app'))
+os.environ.setdefault('JWT_SECRET', 'bench')
+os.environ.setdefault('DATA_ENCRYPTION_KEYS', Fernet.generate_key().decode())
+
+from ws.idle_timer import IdleTimerWheel
+
+
+class IdleConnection:
+    expired = 0
+
+    def __init__(self):
+        self.last_seen = time.monotonic()
+        self.timer_slot = None
+
+    def close(self, code: int = 1000, reason: str = '') -> None:
+        IdleConnection.expired += 1
+
+
+async def per_socket_watchdog(connection: IdleConnection, timeout_s: float, tick_s: float) -> None:
+    while True:
+        await asyncio.sleep(tick_s)
+        if time.monotonic() - connection.last_seen > timeout_s:
+            connection.close(1001, 'Heartbeat timeout')
+            return
+
+
+async def measure(duration_s: float) -> tuple[float, float, float]:
+    lags = []
+    cpu_started, started = time.process_time(), time.perf_counter()
+    while time.perf_counter() - started < duration_s:
+        before = time.perf_counter()
+        await asyncio.sleep(0.01)
+        lags.append((time.perf_counter() - before - 0.01) * 1000)
+    cpu = (time.process_time() - cpu_started) / (time.perf_counter() - started)
+    lags.sort()
+    return cpu, statistics.median(lags), lags[int(len(lags) * 0.99)]
+
+
+async def run_per_socket(count: int, args) -> tuple[float, float, float]:
+    connections = [IdleConnection() for _ in range(count)]
+    tasks = [
+        asyncio.create_task(per_socket_watchdog(connection, args.timeout, args.tick))
+        for connection in connections
+    ]
+    # Let every task reach its first sleep so startup is not measured.
+    await asyncio.sleep(0)
+    try:
+        return await measure(args.duration)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_wheel(count: int, args) -> tuple[float, float, float]:
+    wheel = IdleTimerWheel(args.timeout, args.tick, on_expire=lambda connection: connection.close())
+    for _ in range(count):
+        wheel.add(IdleConnection())
+    await asyncio.sleep(0)
+    try:
+        return await measure(args.duration)
+    finally:
+        await wheel.stop()
+
+
+async def run(args) -> None:
+    print(f'timeout={args.timeout}s tick={args.tick}s duration={args.duration}s')
+    print(f'{"connections":>11} {"mode":>10} {"cpu/s":>7} {"lag p50 ms":>11} {"lag p99 ms":>11} {"expired":>8}')
+    for count in args.connections:
+        for mode, runner in (('per-socket', run_per_socket), ('wheel', run_wheel)):
+            IdleConnection.expired = 0
+            cpu, p50, p99 = await runner(count, args)
+            print(f'{count:>11} {mode:>10} {cpu:>7.1%} {p50:>11.2f} {p99:>11.2f} {IdleConnection.expired:>8}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--timeout', type=float, default=75)
+    parser.add_argument('--tick', type=float, default=5)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()